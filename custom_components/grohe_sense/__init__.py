@@ -1,15 +1,26 @@
-
+import asyncio
 
 import voluptuous as vol
-from .coordinator import GroheDataUpdateCoordinator
+from .coordinator import GroheDataUpdateCoordinator, GroheDevice
 
+from .fleet import GroheFleet
+from .history import async_setup_history
+from .loop_monitor import EventLoopLagMonitor
+from .history_store import HistoryStore
 from .oauth_session import OauthSession
-from .const import CONF_PASSWORD, CONF_USERNAME, DOMAIN,  CONF_PASSWORD, CONF_USERNAME, Platform
-
-from homeassistant.core import HomeAssistant
+from .const import (CONF_PASSWORD, CONF_USERNAME, DOMAIN,  CONF_PASSWORD, CONF_USERNAME, Platform,
+                    ATTR_LOCATION_ID, ATTR_ROOM_ID, ATTR_TIMEOUT, SERVICE_CLOSE_VALVES, SERVICE_OPEN_VALVES,
+                    VALVE_COMMAND_TIMEOUT, CONF_REQUEST_BURST, CONF_REQUEST_RATE, DEFAULT_REQUEST_BURST,
+                    DEFAULT_REQUEST_RATE, DISCOVERY_INTERVAL, CONF_LOOP_LAG_LIMIT, LOOP_LAG_LIMIT,
+                    CONF_DEVICES, CONF_DISCOVERED_AT, HISTORY_DB_FILE, USAGE_PROFILE_INTERVAL,
+                    CONF_FLEET, FLEET_DATA, LOOP_MONITOR_DATA, CONF_REFRESH_TOKEN)
+
+from homeassistant.core import HomeAssistant, ServiceCall, ServiceResponse, SupportsResponse, callback
 from homeassistant.core import Config
 from homeassistant.config_entries import ConfigEntry
 from homeassistant.helpers.aiohttp_client import async_get_clientsession
+from homeassistant.helpers.event import async_track_time_interval
+from homeassistant.util import dt as dt_util
 import homeassistant.helpers.config_validation as cv
 import homeassistant.helpers.entity_registry as er
 import voluptuous as vol
@@ -31,17 +42,75 @@ CONFIG_SCHEMA = vol.Schema(
     extra=vol.ALLOW_EXTRA,
 )
 
+SET_VALVES_SCHEMA = vol.Schema(
+    {
+        vol.Optional(ATTR_LOCATION_ID): vol.All(cv.ensure_list, [cv.string]),
+        vol.Optional(ATTR_ROOM_ID): vol.All(cv.ensure_list, [cv.string]),
+        vol.Optional(ATTR_TIMEOUT, default=VALVE_COMMAND_TIMEOUT): vol.All(vol.Coerce(float), vol.Range(min=1)),
+    }
+)
+
 # https://developers.home-assistant.io/docs/config_entries_index/#setting-up-an-entry
 
 
 async def async_setup(hass: HomeAssistant, config: Config):
     """Set up this integration using YAML is not supported."""
+
+    async def async_handle_set_valves(call: ServiceCall) -> ServiceResponse:
+        """Open or close the valves of all sense guards, across all accounts, concurrently."""
+        state = call.service == SERVICE_OPEN_VALVES
+        coordinators = list(hass.data.get(DOMAIN, {}).values())
+        results = await asyncio.gather(*(
+            coordinator.async_set_valves(
+                state,
+                locations=call.data.get(ATTR_LOCATION_ID),
+                rooms=call.data.get(ATTR_ROOM_ID),
+                timeout=call.data[ATTR_TIMEOUT],
+            ) for coordinator in coordinators))
+        appliances = {}
+        for result in results:
+            appliances.update(result)
+        return {"appliances": appliances}
+
+    for service in (SERVICE_CLOSE_VALVES, SERVICE_OPEN_VALVES):
+        hass.services.async_register(
+            DOMAIN,
+            service,
+            async_handle_set_valves,
+            schema=SET_VALVES_SCHEMA,
+            supports_response=SupportsResponse.OPTIONAL,
+        )
+    async_setup_history(hass)
+
+    # One sleeper for the whole process, however many accounts are configured
+    hass.data[LOOP_MONITOR_DATA] = loop_monitor = EventLoopLagMonitor()
+    hass.async_create_background_task(loop_monitor.async_run(), f"{DOMAIN} event loop lag monitor")
     return True
 
 
 async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
     """Set up this integration using UI."""
     hass.data.setdefault(DOMAIN, {})
+
+    @callback
+    def async_store_refresh_token(refresh_token):
+        hass.config_entries.async_update_entry(entry, data={**entry.data, CONF_REFRESH_TOKEN: refresh_token})
+
+    @callback
+    def async_store_devices(devices):
+        hass.config_entries.async_update_entry(entry, data={
+            **entry.data,
+            CONF_DEVICES: [device._asdict() for device in devices],
+            CONF_DISCOVERED_AT: dt_util.utcnow().isoformat(),
+        })
+
+    # The stored topology saves walking locations and rooms on every start, but only while it's fresh: a /data request
+    # for an appliance that was removed meanwhile would keep the first refresh retrying
+    discovered_at = dt_util.parse_datetime(entry.data.get(CONF_DISCOVERED_AT, ''))
+    devices = None
+    if CONF_DEVICES in entry.data and discovered_at is not None and dt_util.utcnow() - discovered_at <= DISCOVERY_INTERVAL:
+        devices = [GroheDevice(**device) for device in entry.data[CONF_DEVICES]]
+
     hass.data[DOMAIN][entry.entry_id] = coordinator = GroheDataUpdateCoordinator(
         hass=hass,
         client=OauthSession(
@@ -49,14 +118,38 @@ async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
             data=entry.data,
             username=entry.data[CONF_USERNAME],
             password=entry.data[CONF_PASSWORD],
+            request_rate=entry.options.get(CONF_REQUEST_RATE, DEFAULT_REQUEST_RATE),
+            request_burst=entry.options.get(CONF_REQUEST_BURST, DEFAULT_REQUEST_BURST),
+            on_refresh_token=async_store_refresh_token,
         ),
+        loop_lag_limit=entry.options.get(CONF_LOOP_LAG_LIMIT, LOOP_LAG_LIMIT),
+        devices=devices,
+        history_store=HistoryStore(hass.config.path(HISTORY_DB_FILE)),
+        on_discovery=async_store_devices,
     )
     # https://developers.home-assistant.io/docs/integration_fetching_data#coordinated-single-api-poll-for-data-for-all-entities
 
     await coordinator.async_config_entry_first_refresh()
 
+    if entry.options.get(CONF_FLEET, False):
+        # From now on the fleet's shared timer refreshes this account instead of the coordinator's own
+        if FLEET_DATA not in hass.data:
+            hass.data[FLEET_DATA] = GroheFleet(hass)
+        hass.data[FLEET_DATA].async_add(entry.entry_id, coordinator)
+
     await hass.config_entries.async_forward_entry_setups(entry, PLATFORMS)
-    entry.async_on_unload(entry.add_update_listener(async_reload_entry))
+    entry.async_on_unload(async_track_time_interval(hass, coordinator.async_rediscover, DISCOVERY_INTERVAL))
+    entry.async_on_unload(async_track_time_interval(hass, coordinator.async_update_usage_profiles, USAGE_PROFILE_INTERVAL))
+    entry.async_create_background_task(hass, coordinator.async_update_usage_profiles(), f"{DOMAIN} usage profiles")
+
+    options = dict(entry.options)
+
+    async def async_entry_updated(hass: HomeAssistant, entry: ConfigEntry) -> None:
+        # Storing a new refresh token or topology updates the entry too, only changed options need a reload
+        if dict(entry.options) != options:
+            await async_reload_entry(hass, entry)
+
+    entry.async_on_unload(entry.add_update_listener(async_entry_updated))
 
     return True
 
@@ -64,7 +157,13 @@ async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
 async def async_unload_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
     """Handle removal of an entry."""
     if unloaded := await hass.config_entries.async_unload_platforms(entry, PLATFORMS):
-        hass.data[DOMAIN].pop(entry.entry_id)
+        coordinator = hass.data[DOMAIN].pop(entry.entry_id)
+        fleet = hass.data.get(FLEET_DATA)
+        if fleet is not None and entry.entry_id in fleet:
+            fleet.async_remove(entry.entry_id)
+            if not len(fleet):
+                hass.data.pop(FLEET_DATA)
+        await hass.async_add_executor_job(coordinator.history_store.close)
     return unloaded
 
 
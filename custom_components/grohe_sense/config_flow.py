@@ -4,15 +4,21 @@ from __future__ import annotations
 import voluptuous as vol
 from homeassistant import config_entries
 from homeassistant.const import CONF_PASSWORD, CONF_USERNAME
+from homeassistant.core import callback
 from homeassistant.helpers import selector
 import homeassistant.helpers.config_validation as cv
 from homeassistant.helpers.aiohttp_client import async_create_clientsession
 
+from homeassistant.util import dt as dt_util
+
+from .coordinator import async_discover_devices
 from .oauth_session import (
     OauthSession,
     OauthException,
 )
-from .const import DOMAIN, LOGGER
+from .const import (DOMAIN, LOGGER, CONF_REQUEST_BURST, CONF_REQUEST_RATE, DEFAULT_REQUEST_BURST,
+                    DEFAULT_REQUEST_RATE, CONF_LOOP_LAG_LIMIT, LOOP_LAG_LIMIT, CONF_DEVICES, CONF_DISCOVERED_AT,
+                    CONF_REFRESH_TOKEN, CONF_FLEET)
 
 
 class GroheFlowHandler(config_entries.ConfigFlow, domain=DOMAIN):
@@ -20,6 +26,11 @@ class GroheFlowHandler(config_entries.ConfigFlow, domain=DOMAIN):
 
     VERSION = 1
 
+    @staticmethod
+    @callback
+    def async_get_options_flow(config_entry: config_entries.ConfigEntry) -> config_entries.OptionsFlow:
+        return GroheOptionsFlowHandler(config_entry)
+
     async def async_step_user(
         self,
         user_input: dict | None = None,
@@ -28,9 +39,10 @@ class GroheFlowHandler(config_entries.ConfigFlow, domain=DOMAIN):
         _errors = {}
         if user_input is not None:
             try:
-                devices = await self._test_credentials(
+                refresh_token, devices = await self._test_credentials(
                     username=user_input[CONF_USERNAME],
                     password=user_input[CONF_PASSWORD],
+                    data=user_input,
                 )
             except OauthException as exception:
                 LOGGER.warning(exception)
@@ -42,9 +54,15 @@ class GroheFlowHandler(config_entries.ConfigFlow, domain=DOMAIN):
                 LOGGER.exception(exception)
                 _errors["base"] = "unknown"
             else:
+                # Hand the login and discovery over to the entry, so setup can start without repeating them
                 return self.async_create_entry(
                     title=user_input[CONF_USERNAME],
-                    data=user_input,
+                    data={
+                        **user_input,
+                        CONF_REFRESH_TOKEN: refresh_token,
+                        CONF_DEVICES: [device._asdict() for device in devices],
+                        CONF_DISCOVERED_AT: dt_util.utcnow().isoformat(),
+                    },
                 )
 
         return self.async_show_form(
@@ -70,11 +88,54 @@ class GroheFlowHandler(config_entries.ConfigFlow, domain=DOMAIN):
             errors=_errors,
         )
 
-    async def _test_credentials(self, username: str, password: str) -> None:
-        """Validate credentials."""
+    async def _test_credentials(self, username: str, password: str, data: dict) -> tuple:
+        """Validate credentials, return the refresh token and the discovered devices."""
         client = OauthSession(
             username=username,
             password=password,
+            data=data,
             session=async_create_clientsession(self.hass),
         )
-        await client.async_get_devices()
+        await client.token()
+        devices = await async_discover_devices(client)
+        return client.refresh_token, devices
+
+class GroheOptionsFlowHandler(config_entries.OptionsFlow):
+    """Options flow for Grohe."""
+
+    def __init__(self, config_entry: config_entries.ConfigEntry) -> None:
+        """Initialize options flow."""
+        self._config_entry = config_entry
+
+    async def async_step_init(
+        self,
+        user_input: dict | None = None,
+    ) -> config_entries.FlowResult:
+        """Manage the request budget, the event loop lag limit and fleet membership."""
+        if user_input is not None:
+            return self.async_create_entry(title="", data=user_input)
+
+        options = self._config_entry.options
+        return self.async_show_form(
+            step_id="init",
+            data_schema=vol.Schema(
+                {
+                    vol.Optional(
+                        CONF_REQUEST_RATE,
+                        default=options.get(CONF_REQUEST_RATE, DEFAULT_REQUEST_RATE),
+                    ): vol.All(vol.Coerce(float), vol.Range(min=0.1)),
+                    vol.Optional(
+                        CONF_REQUEST_BURST,
+                        default=options.get(CONF_REQUEST_BURST, DEFAULT_REQUEST_BURST),
+                    ): vol.All(vol.Coerce(int), vol.Range(min=1)),
+                    vol.Optional(
+                        CONF_LOOP_LAG_LIMIT,
+                        default=options.get(CONF_LOOP_LAG_LIMIT, LOOP_LAG_LIMIT),
+                    ): vol.All(vol.Coerce(float), vol.Range(min=0.01)),
+                    vol.Optional(
+                        CONF_FLEET,
+                        default=options.get(CONF_FLEET, False),
+                    ): bool,
+                }
+            ),
+        )
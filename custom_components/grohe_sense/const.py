@@ -19,6 +19,9 @@ VERSION = "1.1.0"
 
 CONF_USERNAME = 'username'
 CONF_PASSWORD = 'password'
+CONF_REFRESH_TOKEN = 'refresh_token'
+CONF_DEVICES = 'devices'  # Topology discovered by the config flow, so setup doesn't have to walk it again
+CONF_DISCOVERED_AT = 'discovered_at'
 
 PLATFORMS = ['sensor']
 
@@ -30,6 +33,19 @@ GROHE_BASE_URL = 'https://idp2-apigw.cloud.grohe.com/'
 BASE_URL = GROHE_BASE_URL + 'v3/iot/'
 
 
+# Request scheduling: every request to the API waits for a slot from a per-account token bucket,
+# queued requests are served by priority (lowest value first).
+CONF_REQUEST_RATE = 'request_rate'
+CONF_REQUEST_BURST = 'request_burst'
+DEFAULT_REQUEST_RATE = 2.0  # Requests per second, sustained
+DEFAULT_REQUEST_BURST = 10  # Requests that may go out back-to-back
+
+PRIORITY_AUTH = 0
+PRIORITY_COMMAND = 1
+PRIORITY_TELEMETRY = 2
+PRIORITY_NOTIFICATION = 3
+
+
 GROHE_SENSE_TYPE = 101  # Type identifier for the battery powered water detector
 GROHE_SENSE_GUARD_TYPE = 103  # Type identifier for sense guard, the water guard installed on your water pipe
 GROHE_BLUE_HOME_TYPE = 104  # Type identifier for Grohe Blue Home, chiled water tap
@@ -113,6 +129,93 @@ SENSOR_TYPES_PER_UNIT = {
 # 'cleaning_count' ]
 
 NOTIFICATION_UPDATE_DELAY = timedelta(minutes=1)
+NOTIFICATION_PAGE_SIZE = 50  # Newest notifications requested per poll
+NOTIFICATION_HISTORY_SIZE = 50  # Recent notifications kept per appliance
+NOTIFICATION_CATEGORY_CRITICAL = 30  # Flooding, pipe break and the like
+EVENT_NOTIFICATION = 'grohe_sense_notification'  # Fired once for every notification that was not seen before
+
+DISCOVERY_INTERVAL = timedelta(hours=6)  # How often the locations/rooms/appliances topology is walked again
+WITHDRAWAL_HISTORY = timedelta(days=7)  # Withdrawals kept in memory, also the initial poll window of a new appliance
+
+# What to fetch from /data per appliance type: how far back a new appliance is polled, whether withdrawals
+# are wanted at all, which measurement keys are parsed and kept, which fields of a withdrawal are kept, and
+# which measurement keys get their history kept in the time series store.
+FetchStrategy = collections.namedtuple('FetchStrategy', ['window', 'withdrawals', 'measurements', 'withdrawal_fields', 'series'])
+
+WITHDRAWAL_FIELDS = ('starttime', 'stoptime', 'waterconsumption', 'maxflowrate')
+
+FETCH_STRATEGIES = {
+    # Battery powered, uploads once a day and never reports withdrawals
+    GROHE_SENSE_TYPE: FetchStrategy(timedelta(days=2), False, SENSOR_TYPES_PER_UNIT[GROHE_SENSE_TYPE], (),
+                                    SENSOR_TYPES_PER_UNIT[GROHE_SENSE_TYPE]),
+    GROHE_SENSE_GUARD_TYPE: FetchStrategy(WITHDRAWAL_HISTORY, True, SENSOR_TYPES_PER_UNIT[GROHE_SENSE_GUARD_TYPE], WITHDRAWAL_FIELDS,
+                                          SENSOR_TYPES_PER_UNIT[GROHE_SENSE_GUARD_TYPE]),
+    # Only the latest counters are used
+    GROHE_BLUE_HOME_TYPE: FetchStrategy(timedelta(days=1), False, SENSOR_TYPES_PER_UNIT[GROHE_BLUE_HOME_TYPE], (), ()),
+}
+DEFAULT_FETCH_STRATEGY = FetchStrategy(timedelta(days=1), False, [], (), ())
+
+# Responses with more samples than this (or login pages larger than this many characters, JSON bodies
+# larger than this many bytes) are parsed in an executor rather than on the event loop.
+PARSE_OFFLOAD_THRESHOLD = 500
+HTML_OFFLOAD_THRESHOLD = 16384
+JSON_OFFLOAD_THRESHOLD = 262144  # Bytes
+
+# Measurement history: raw samples for MEASUREMENT_RAW_RETENTION, then (resolution, retention) tiers of min/max/mean buckets
+MEASUREMENT_RAW_RETENTION = timedelta(hours=6)
+MEASUREMENT_RAW_SIZE = 1440  # Upper bound on raw samples per series, in case an appliance reports very often
+MEASUREMENT_TIERS = [
+    (timedelta(hours=1), timedelta(days=7)),
+    (timedelta(days=1), timedelta(weeks=8)),
+]
+
+# On-disk history in the Home Assistant config dir: raw withdrawals and measurement samples are kept for their
+# retention, then compacted into daily aggregates
+HISTORY_DB_FILE = 'grohe_sense.db'
+HISTORY_WITHDRAWAL_RETENTION = timedelta(days=90)
+HISTORY_MEASUREMENT_RETENTION = MEASUREMENT_TIERS[-1][1]  # As long as the in-memory tiers, so restarts don't lose them
+HISTORY_WITHDRAWAL_FIELDS = ('waterconsumption', 'maxflowrate')  # Withdrawal fields kept in the daily aggregates
+HISTORY_COMPACT_INTERVAL = timedelta(days=1)
+
+# Usage profiles of sense guards, computed from the stored withdrawals of the last USAGE_PROFILE_WINDOW
+USAGE_PROFILE_INTERVAL = timedelta(hours=1)
+USAGE_PROFILE_WINDOW = HISTORY_WITHDRAWAL_RETENTION
+USAGE_PROFILE_PERCENTILES = (10, 25, 50, 75, 90, 95, 99)
+
+UPDATE_INTERVAL = timedelta(minutes=4)
+
+# Accounts with the fleet option have their refreshes run, staggered, by one shared timer instead of their own
+CONF_FLEET = 'fleet'
+FLEET_DATA = f'{DOMAIN}_fleet'  # hass.data key, hass.data[DOMAIN] only holds coordinators
+
+CONF_LOOP_LAG_LIMIT = 'loop_lag_limit'
+LOOP_LAG_LIMIT = 0.1  # Seconds the event loop may be blocked before it's logged
+LOOP_LAG_INTERVAL = 1  # Seconds between event loop lag probes
+LOOP_MONITOR_DATA = f'{DOMAIN}_loop_monitor'  # hass.data key of the one event loop lag sleeper
+
+SERVICE_CLOSE_VALVES = 'close_valves'
+SERVICE_OPEN_VALVES = 'open_valves'
+
+ATTR_LOCATION_ID = 'location_id'
+ATTR_ROOM_ID = 'room_id'
+ATTR_TIMEOUT = 'timeout'
+
+SERVICE_GET_HISTORY = 'get_history'
+
+ATTR_APPLIANCE_ID = 'appliance_id'
+ATTR_KIND = 'kind'
+ATTR_KEY = 'key'
+ATTR_START_TIME = 'start_time'
+ATTR_END_TIME = 'end_time'
+ATTR_BUCKET = 'bucket'
+ATTR_AGGREGATE = 'aggregate'
+ATTR_OFFSET = 'offset'
+ATTR_LIMIT = 'limit'
+
+HISTORY_PAGE_SIZE = 500
+HISTORY_MAX_PAGE_SIZE = 5000
+
+VALVE_COMMAND_TIMEOUT = 30  # Seconds allowed per appliance for setting a valve and reading it back
 
 NOTIFICATION_TYPES = {  # The protocol returns notification information as a (category, type) tuple, this maps to strings
     (10, 10): 'Integration successful',
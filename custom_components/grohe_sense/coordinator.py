@@ -8,8 +8,10 @@ from datetime import (datetime, timezone, timedelta)
 from .oauth_session import OauthSession, TokenExpiredError
 
 from homeassistant.config_entries import ConfigEntry
-from homeassistant.core import HomeAssistant
+from homeassistant.core import HomeAssistant, callback
 from homeassistant.exceptions import ConfigEntryAuthFailed
+from homeassistant.helpers import device_registry as dr
+from homeassistant.util import dt as dt_util
 
 from homeassistant.helpers.update_coordinator import (
     DataUpdateCoordinator,
@@ -20,11 +22,100 @@ from .oauth_session import (
     OauthSession,
     OauthException,
 )
-from .const import DOMAIN, GROHE_SENSE_TYPE, LOGGER, SENSOR_TYPES_PER_UNIT, STATE_UNKNOWN
+from .const import (DOMAIN, GROHE_SENSE_GUARD_TYPE, LOGGER, STATE_UNKNOWN, VALVE_COMMAND_TIMEOUT, EVENT_NOTIFICATION,
+                    NOTIFICATION_PAGE_SIZE, FETCH_STRATEGIES, DEFAULT_FETCH_STRATEGY, LOOP_LAG_LIMIT, PARSE_OFFLOAD_THRESHOLD,
+                    USAGE_PROFILE_WINDOW, UPDATE_INTERVAL)
+from .history_store import HistoryStore
+from .loop_monitor import EventLoopLagMonitor
+from .notifications import NotificationIndex, describe_notification
+from .single_flight import SingleFlight
+from .timeseries import TimeSeriesStore
+from .usage_profile import load_usage_profiles
 
 GroheDevice = collections.namedtuple('GroheDevice', ['locationId', 'roomId', 'applianceId', 'type', 'name'])
 
 
+async def async_discover_devices(client):
+    """ Walks locations, rooms and appliances, returns a GroheDevice per appliance """
+    devices = []
+    LOGGER.debug('fetching locations')
+
+    locations = await client.get_locations()
+    LOGGER.debug('Found locations %s', locations)
+
+    for location in locations:
+        LOGGER.debug('Found location %s', location)
+        locationId = location['id']
+        rooms = await client.get_rooms(locationId)
+        for room in rooms:
+            LOGGER.debug('Found room %s', room)
+            roomId = room['id']
+            appliances = await client.get_appliances(locationId, roomId)
+            for appliance in appliances:
+                LOGGER.debug('Found appliance %s', appliance)
+                applianceId = appliance['appliance_id']
+                devices.append(GroheDevice(locationId, roomId, applianceId, appliance['type'], appliance['name']))
+    return devices
+
+
+def parse_time(s):
+    try:
+        # Much cheaper than strptime, which matters now that every measurement sample gets parsed
+        return datetime.fromisoformat(s)
+    except ValueError:
+        pass
+    # XXX: Fix for python 3.6 - Grohe emits time zone as "+HH:MM", python 3.6's %z only accepts the format +HHMM
+    # So, some ugly code to remove the colon for now...
+    if s.rfind(':') > s.find('+'):
+        s = s[:s.rfind(':')] + s[s.rfind(':')+1:]
+    return datetime.strptime(s, '%Y-%m-%dT%H:%M:%S.%f%z')
+
+
+def parse_data_response(strategy, response, poll_from, applianceId, series_since=None):
+    """ Parses a /data response as the strategy says. Pure, so large responses can be parsed in an executor.
+
+    Returns the withdrawals newer than poll_from (sorted), the latest value of each measurement key, the
+    (timestamp, {key: value}) measurement samples newer than series_since (sorted) and the new watermark.
+    """
+    withdrawals = []
+    measurements = {}
+    series = []
+
+    if strategy.withdrawals and 'withdrawals' in response['data']:
+        withdrawals = response['data']['withdrawals']
+        LOGGER.debug('Received %d withdrawals in response', len(withdrawals))
+        withdrawals = [{field: w[field] for field in strategy.withdrawal_fields if field in w} for w in withdrawals]
+        for w in withdrawals:
+            w['starttime'] = parse_time(w['starttime'])
+        withdrawals = [w for w in withdrawals if w['starttime'] > poll_from]
+        withdrawals.sort(key=lambda x: x['starttime'])
+
+        LOGGER.debug('Got %d new withdrawals totaling %f volume', len(withdrawals), sum((w['waterconsumption'] for w in withdrawals)))
+        if len(withdrawals) > 0:
+            poll_from = max(poll_from, withdrawals[-1]['starttime'])
+    elif strategy.withdrawals:
+        LOGGER.info('Data response for appliance %s did not contain any withdrawals data', applianceId)
+
+    if 'measurement' in response['data']:
+        samples = response['data']['measurement']
+        if len(samples):
+            latest = max(samples, key=lambda x: x['timestamp'])
+            for key in strategy.measurements:
+                if key in latest:
+                    measurements[key] = latest[key]
+            poll_from = max(poll_from, parse_time(latest['timestamp']))
+        if strategy.series:
+            for sample in samples:
+                t = parse_time(sample['timestamp'])
+                if series_since is None or t > series_since:
+                    series.append((t, {key: sample[key] for key in strategy.series if key in sample}))
+            series.sort(key=lambda x: x[0])
+    else:
+        LOGGER.info('Data response for appliance %s did not contain any measurements data', applianceId)
+
+    return withdrawals, measurements, series, poll_from
+
+
 # https://developers.home-assistant.io/docs/integration_fetching_data#coordinated-single-api-poll-for-data-for-all-entities
 class GroheDataUpdateCoordinator(DataUpdateCoordinator):
     """Class to manage fetching data from the API."""
@@ -35,28 +126,46 @@ class GroheDataUpdateCoordinator(DataUpdateCoordinator):
         self,
         hass: HomeAssistant,
         client: OauthSession,
+        loop_lag_limit: float = LOOP_LAG_LIMIT,
+        devices: list[GroheDevice] | None = None,
+        history_store: HistoryStore | None = None,
+        on_discovery=None,
     ) -> None:
         """Initialize."""
         self.client = client
+        self.loop_monitor = EventLoopLagMonitor(loop_lag_limit)
         self._data_fetch_completed = datetime.min
-        self._poll_from = datetime.now(tz=timezone.utc) - timedelta(7)
-        self._fetching_data = None
-        self._fetching_devices = None
+        self._poll_from = {}
+        self._fetching_data = SingleFlight('data fetch')
+        self._fetching_devices = SingleFlight('device discovery')
         self._locationId = None
         self._applianceId = None
-        self._devices = None
+        self._devices = devices
+        self._on_discovery = on_discovery
         self._device_data = {}
+        self._valve_states = {}
+        self._device_listeners = []
+        self._notifications = {}
+        self.series = TimeSeriesStore()
+        self.history_store = history_store
+        self._history_loaded = history_store is None
+        self._pending_history = []
+        self._usage_profiles = {}
 
         super().__init__(
             hass=hass,
             logger=LOGGER,
             name=DOMAIN,
-            update_interval=timedelta(minutes=4),
+            update_interval=UPDATE_INTERVAL,
         )
 
     async def get_devices(self):
         return await self.async_get_devices()
 
+    def known_devices(self):
+        """ The devices found so far, without triggering discovery """
+        return self._devices or []
+
     async def _async_update_data(self):
         """Update data via library."""
         try:
@@ -69,119 +178,302 @@ class GroheDataUpdateCoordinator(DataUpdateCoordinator):
             raise UpdateFailed(exception) from exception
 
     def consumption(self, applianceId, since):
-        if self.data is not None:
+        if self.data is not None and applianceId in self.data:
             # XXX: As self._withdrawals is sorted, we could speed this up by a binary search,
             #      but most likely data sets are small enough that a linear scan is fine.
             return sum((w['waterconsumption'] for w in self.data[applianceId]['withdrawals'] if w['starttime'] >= since))
         return STATE_UNKNOWN
 
     def measurement(self, applianceId, key):
-        if self.data is not None and key in self.data[applianceId]['measurements']:
+        if self.data is not None and applianceId in self.data and key in self.data[applianceId]['measurements']:
             return self.data[applianceId]['measurements'][key]
         return STATE_UNKNOWN
 
+    def measurement_series(self, applianceId, key, start=None, end=None):
+        """ Stored history of a measurement, oldest first, at decreasing resolution as it ages """
+        return self.series.query(applianceId, key, start, end)
+
+    def usage_profile(self, applianceId):
+        return self._usage_profiles.get(applianceId)
+
+    def active_notifications(self, applianceId):
+        """ The notifications of the appliance's latest notifications response """
+        index = self._notifications.get(applianceId)
+        return index.current if index is not None else []
+
+    def valve_state(self, applianceId):
+        return self._valve_states.get(applianceId, STATE_UNKNOWN)
+
+    async def async_get_notifications(self, device):
+        """ Fetches the newest notifications of an appliance into its NotificationIndex, and fires an
+        EVENT_NOTIFICATION for each notification that was not seen before """
+        index = self._notifications.setdefault(device.applianceId, NotificationIndex())
+        version = index.version
+        notifications = await self.client.get_notifications(device.locationId, device.roomId, device.applianceId, NOTIFICATION_PAGE_SIZE)
+        for notification in index.update(notifications):
+            LOGGER.debug('New notification for %s: %s', device.name, notification)
+            self.hass.bus.async_fire(EVENT_NOTIFICATION, {
+                'appliance_id': device.applianceId,
+                'name': device.name,
+                'category': notification.get('category'),
+                'type': notification.get('type'),
+                'notification': describe_notification(notification),
+                'timestamp': notification.get('timestamp'),
+            })
+        if index.version != version:
+            self.async_update_listeners()
+        return index
+
+    async def async_get_valve(self, device):
+        """ Reads the valve state of a sense guard back from its /command endpoint, None if it can't be parsed """
+        command_response = await self.client.get_command(device.locationId, device.roomId, device.applianceId)
+        if 'command' in command_response and 'valve_open' in command_response['command']:
+            return self._set_valve_state(device.applianceId, command_response['command']['valve_open'])
+        LOGGER.error('Failed to parse out valve_open from commands response: %s', command_response)
+        return None
+
+    def _set_valve_state(self, applianceId, valve_open):
+        """ Records a valve state, and lets the valve switch and the fleet totals know when it changed """
+        if self._valve_states.get(applianceId) != valve_open:
+            self._valve_states[applianceId] = valve_open
+            self.async_update_listeners()
+        return valve_open
+
+    async def async_set_valve(self, device, state):
+        """ Opens (state=True) or closes (state=False) the valve of a sense guard, returns the state the API reports back """
+        data = {'type': GROHE_SENSE_GUARD_TYPE, 'command': {'valve_open': state}}
+        command_response = await self.client.post_command(device.locationId, device.roomId, device.applianceId, data)
+        if 'command' in command_response and 'valve_open' in command_response['command']:
+            return self._set_valve_state(device.applianceId, command_response['command']['valve_open'])
+        LOGGER.warning('Got unknown response back when setting valve state: %s', command_response)
+        return None
+
+    async def async_set_valves(self, state, locations=None, rooms=None, timeout=VALVE_COMMAND_TIMEOUT):
+        """ Sets the valve of every sense guard (optionally limited to some locations/rooms) concurrently.
+
+        Each appliance gets its own deadline of timeout seconds for the command and the /command read-back,
+        so one unreachable guard can't hold up the others. Returns a result dict per appliance id.
+        """
+        devices = [device for device in await self.async_get_devices()
+                   if device.type == GROHE_SENSE_GUARD_TYPE
+                   and (not locations or str(device.locationId) in locations)
+                   and (not rooms or str(device.roomId) in rooms)]
+        LOGGER.info('Setting valve_open=%s for %d sense guard(s)', state, len(devices))
+        results = await asyncio.gather(*(self._async_set_valve_confirmed(device, state, timeout) for device in devices))
+        return {str(device.applianceId): result for device, result in zip(devices, results)}
+
+    async def _async_set_valve_confirmed(self, device, state, timeout):
+        async def set_and_read_back():
+            await self.async_set_valve(device, state)
+            return await self.async_get_valve(device)
+
+        result = {'name': device.name, 'location_id': device.locationId, 'room_id': device.roomId, 'requested': state}
+        try:
+            valve_open = await asyncio.wait_for(set_and_read_back(), timeout)
+        except asyncio.TimeoutError:
+            LOGGER.warning('Timed out after %ss setting valve for %s', timeout, device.name)
+            result['status'] = 'timeout'
+        except Exception as exception:
+            LOGGER.warning('Failed to set valve for %s: %s', device.name, exception)
+            result['status'] = 'error'
+            result['error'] = str(exception)
+        else:
+            result['valve_open'] = valve_open
+            result['status'] = 'confirmed' if valve_open == state else 'unconfirmed'
+        return result
+
     async def async_get_devices(self):
 
         if self._devices is not None:
             return self._devices
 
-        if self._fetching_devices is not None:
-            await self._fetching_devices.wait()
-            return self._devices
-        self._fetching_devices = asyncio.Event()
-
-        devices = []
-        LOGGER.debug('fetching locations')
-
-        locations = await self.client.get_locations()
-        LOGGER.debug('Found locations %s', locations)
-
-        for location in locations:
-            LOGGER.debug('Found location %s', location)
-            locationId = location['id']
-            rooms = await self.client.get_rooms(locationId)
-            for room in rooms:
-                LOGGER.debug('Found room %s', room)
-                roomId = room['id']
-                appliances = await self.client.get_appliances(locationId, roomId)
-                for appliance in appliances:
-                    LOGGER.debug('Found appliance %s', appliance)
-                    applianceId = appliance['appliance_id']
-                    devices.append(GroheDevice(locationId, roomId, applianceId, appliance['type'], appliance['name']))
-        self._devices = devices
+        return await self._fetching_devices.run(self._async_load_devices)
 
-        self._fetching_devices.set()
-        self._fetching_devices = None
+    async def _async_load_devices(self):
+        self._devices = await self._async_fetch_topology()
+        self._discovered(self._devices)
         return self._devices
 
+    def _discovered(self, devices):
+        """ Hands a freshly walked topology to on_discovery, so it can be stored for the next start """
+        if self._on_discovery is not None:
+            self._on_discovery(devices)
+
+    async def _async_fetch_topology(self):
+        return await async_discover_devices(self.client)
+
+    @callback
+    def async_add_device_listener(self, update_callback):
+        """ Registers update_callback(added, removed) to be called with the devices rediscovery added or removed.
+        Returns a function that unregisters it again. """
+        self._device_listeners.append(update_callback)
+
+        @callback
+        def remove_listener():
+            self._device_listeners.remove(update_callback)
+
+        return remove_listener
+
+    async def async_rediscover(self, now=None):
+        """ Walks the topology again and diffs it against the known devices.
+
+        Unchanged appliances keep their data (and poll watermark), so only new appliances get a full history fetch
+        on the next refresh. Devices of removed appliances are dropped from the device registry.
+        """
+        if self._devices is None:
+            return
+        try:
+            devices = await self._async_fetch_topology()
+        except Exception as exception:
+            LOGGER.warning('Rediscovery of Grohe appliances failed: %s', exception)
+            return
+
+        known = {device.applianceId: device for device in self._devices}
+        current = {device.applianceId: device for device in devices}
+        added = [device for applianceId, device in current.items() if known.get(applianceId) != device]
+        removed = [device for applianceId, device in known.items() if current.get(applianceId) != device]
+        self._devices = devices
+        self._discovered(devices)
+        if not added and not removed:
+            LOGGER.debug('Rediscovery found no changes in %d appliance(s)', len(devices))
+            return
+        LOGGER.info('Rediscovery found %d new and %d removed appliance(s)', len(added), len(removed))
+
+        device_registry = dr.async_get(self.hass)
+        gone = []
+        for device in removed:
+            if device.applianceId in current:  # Moved or renamed, it keeps its entities and its data
+                continue
+            self._device_data.pop(device.applianceId, None)
+            self._valve_states.pop(device.applianceId, None)
+            self._notifications.pop(device.applianceId, None)
+            self.series.remove(device.applianceId)
+            self._poll_from.pop(device.applianceId, None)
+            self._usage_profiles.pop(device.applianceId, None)
+            gone.append(device.applianceId)
+            registry_entry = device_registry.async_get_device(identifiers={(DOMAIN, device.applianceId)})
+            if registry_entry is not None and self.config_entry is not None:
+                device_registry.async_update_device(registry_entry.id, remove_config_entry_id=self.config_entry.entry_id)
+
+        if gone and self.history_store is not None:
+            try:
+                await self.hass.async_add_executor_job(self.history_store.remove, gone)
+            except Exception as exception:
+                LOGGER.warning('Failed to remove history of removed appliances: %s', exception)
+
+        for update_callback in list(self._device_listeners):
+            update_callback(added, removed)
+
     async def async_get_data(self):
-        if self._fetching_data is not None:
-            await self._fetching_data.wait()
-            return self._device_data
+        return await self._fetching_data.run(self._async_fetch_data)
 
+    async def _async_fetch_data(self):
         # XXX: Hardcoded 15 minute interval for now. Would be prettier to set this a bit more dynamically
         # based on the json response for the sense guard, and probably hardcode something longer for the sense.
         if datetime.now() - self._data_fetch_completed < timedelta(minutes=5):
             LOGGER.debug('Skipping fetching new data, time since last fetch was only %s', datetime.now() - self._data_fetch_completed)
             return self._device_data
 
-        self._fetching_data = asyncio.Event()
         await self.async_get_devices()
+        if not self._history_loaded:
+            await self._async_load_history()
 
         device_data = {}
         for device in self._devices:
             device_data[device.applianceId] = await self.async_get_data_for_device(device)
         self._device_data = device_data
+        await self._async_save_history()
 
         self._data_fetch_completed = datetime.now()
-
-        self._fetching_data.set()
-        self._fetching_data = None
+        LOGGER.debug('Request scheduler after refresh: %s, transfer: %s', self.client.scheduler.stats(), self.client.transfer_stats)
 
         return self._device_data
 
+    async def _async_load_history(self):
+        """ Resumes from the history store: poll watermarks, the withdrawals within each strategy's window,
+        the latest measurements and the stored measurement samples """
+        now = datetime.now(tz=timezone.utc)
+        windows = {device.applianceId: now - FETCH_STRATEGIES.get(device.type, DEFAULT_FETCH_STRATEGY).window
+                   for device in self._devices}
+        try:
+            history = await self.hass.async_add_executor_job(self.history_store.load, windows)
+        except Exception as exception:
+            LOGGER.warning('Failed to load history from %s, fetching it again: %s', self.history_store.path, exception)
+            history = {}
+        for applianceId, stored in history.items():
+            self._poll_from[applianceId] = stored['poll_from']
+            self._device_data[applianceId] = {'measurements': stored['measurements'], 'withdrawals': stored['withdrawals']}
+            self.series.add(applianceId, stored['series'], now)
+        LOGGER.debug('Resumed %d of %d appliance(s) from stored history', len(history), len(windows))
+        self._history_loaded = True
+
+    async def _async_save_history(self):
+        """ Writes what this refresh fetched to the history store, in one transaction in an executor """
+        batch, self._pending_history = self._pending_history, []
+        if self.history_store is None or not batch:
+            return
+        try:
+            await self.hass.async_add_executor_job(self.history_store.save, batch, datetime.now(tz=timezone.utc))
+        except Exception as exception:
+            # The data is still in memory, and the watermarks stored before are older, so it's fetched again after a restart
+            LOGGER.warning('Failed to write history to %s: %s', self.history_store.path, exception)
+
+    async def async_update_usage_profiles(self, now=None):
+        """ Recomputes the usage profile of every sense guard from the history store, in an executor """
+        if self.history_store is None or not self._history_loaded:
+            return
+        applianceIds = [device.applianceId for device in self.known_devices() if device.type == GROHE_SENSE_GUARD_TYPE]
+        if not applianceIds:
+            return
+        now = datetime.now(tz=timezone.utc)
+        try:
+            self._usage_profiles = await self.hass.async_add_executor_job(
+                load_usage_profiles, self.history_store, applianceIds, dt_util.now().tzinfo, now - USAGE_PROFILE_WINDOW, now)
+        except Exception as exception:
+            LOGGER.warning('Failed to compute usage profiles: %s', exception)
+            return
+        self.async_update_listeners()
+
+    def single_flight_stats(self):
+        """ How many calls each single flight path had, and how many of them were coalesced into a call in flight """
+        return {
+            'devices': self._fetching_devices.stats(),
+            'data': self._fetching_data.stats(),
+            'token': self.client.fetching_token.stats(),
+        }
+
     async def async_get_data_for_device(self, device):
+        strategy = FETCH_STRATEGIES.get(device.type, DEFAULT_FETCH_STRATEGY)
+        previous = self._device_data.get(device.applianceId, {})
+        cutoff = datetime.now(tz=timezone.utc) - strategy.window
         data = {
-            "measurements": {},
-            "withdrawals": []
+            "measurements": dict(previous.get('measurements', {})),
+            "withdrawals": [w for w in previous.get('withdrawals', []) if w['starttime'] >= cutoff]
         }
         LOGGER.debug("Fetching new data for appliance %s", device.applianceId)
 
-        def parse_time(s):
-            # XXX: Fix for python 3.6 - Grohe emits time zone as "+HH:MM", python 3.6's %z only accepts the format +HHMM
-            # So, some ugly code to remove the colon for now...
-            if s.rfind(':') > s.find('+'):
-                s = s[:s.rfind(':')] + s[s.rfind(':')+1:]
-            return datetime.strptime(s, '%Y-%m-%dT%H:%M:%S.%f%z')
-
-        poll_from = self._poll_from.strftime('%Y-%m-%d')
+        # Each appliance has its own watermark, so an appliance added by rediscovery gets a full history fetch
+        # without moving the others back.
+        device_poll_from = self._poll_from.get(device.applianceId, cutoff)
+        poll_from = device_poll_from.strftime('%Y-%m-%d')
 
         measurements_response = await self.client.get_measurements_response(device.locationId, device.roomId, device.applianceId, poll_from)
 
-        if 'withdrawals' in measurements_response['data']:
-            withdrawals = measurements_response['data']['withdrawals']
-            LOGGER.debug('Received %d withdrawals in response', len(withdrawals))
-            for w in withdrawals:
-                w['starttime'] = parse_time(w['starttime'])
-            withdrawals = [w for w in withdrawals if w['starttime'] > self._poll_from]
-            withdrawals.sort(key=lambda x: x['starttime'])
-
-            LOGGER.debug('Got %d new withdrawals totaling %f volume', len(withdrawals), sum((w['waterconsumption'] for w in withdrawals)))
-            data['withdrawals'] += withdrawals
-            if len(data['withdrawals']) > 0:
-                self._poll_from = max(self._poll_from, data['withdrawals'][-1]['starttime'])
-        elif self._type != GROHE_SENSE_TYPE:
-            LOGGER.info('Data response for appliance %s did not contain any withdrawals data', device.applianceId)
-
-        if 'measurement' in measurements_response['data']:
-            measurements = measurements_response['data']['measurement']
-            measurements.sort(key=lambda x: x['timestamp'])
-            if len(measurements):
-                for key in SENSOR_TYPES_PER_UNIT[device.type]:
-                    if key in measurements[-1]:
-                        data['measurements'][key] = measurements[-1][key]
-                self._poll_from = max(self._poll_from, parse_time(measurements[-1]['timestamp']))
+        series_since = self.series.last(device.applianceId)
+        samples = sum(len(measurements_response['data'].get(key, ())) for key in ('withdrawals', 'measurement'))
+        if samples > PARSE_OFFLOAD_THRESHOLD:
+            LOGGER.debug('Parsing %d samples for appliance %s in executor', samples, device.applianceId)
+            withdrawals, measurements, series, device_poll_from = await self.hass.async_add_executor_job(
+                parse_data_response, strategy, measurements_response, device_poll_from, device.applianceId, series_since)
         else:
-            LOGGER.info('Data response for appliance %s did not contain any measurements data', device.applianceId)
-
+            with self.loop_monitor.timed(f'Parsing data for appliance {device.applianceId}'):
+                withdrawals, measurements, series, device_poll_from = parse_data_response(
+                    strategy, measurements_response, device_poll_from, device.applianceId, series_since)
+
+        data['withdrawals'] += withdrawals
+        data['measurements'].update(measurements)
+        self.series.add(device.applianceId, series, datetime.now(tz=timezone.utc))
+        self._poll_from[device.applianceId] = device_poll_from
+        if self.history_store is not None:
+            self._pending_history.append((device.applianceId, withdrawals, series, device_poll_from, data['measurements']))
         return data
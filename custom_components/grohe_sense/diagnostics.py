@@ -0,0 +1,19 @@
+"""Diagnostics support for Grohe Sense."""
+from __future__ import annotations
+
+from homeassistant.config_entries import ConfigEntry
+from homeassistant.core import HomeAssistant
+
+from .const import DOMAIN, LOOP_MONITOR_DATA
+
+
+async def async_get_config_entry_diagnostics(hass: HomeAssistant, entry: ConfigEntry) -> dict:
+    """Return diagnostics for a config entry."""
+    coordinator = hass.data[DOMAIN][entry.entry_id]
+    return {
+        "request_scheduler": coordinator.client.scheduler.stats(),
+        "transfer": coordinator.client.transfer_stats,
+        "event_loop": coordinator.loop_monitor.stats(),
+        "event_loop_lag": hass.data[LOOP_MONITOR_DATA].stats() if LOOP_MONITOR_DATA in hass.data else None,
+        "single_flight": coordinator.single_flight_stats(),
+    }
@@ -1,5 +1,7 @@
 """GroheEntity class"""
 
+from homeassistant.core import callback
+from homeassistant.helpers import entity_registry as er
 from homeassistant.helpers.update_coordinator import CoordinatorEntity
 
 from .const import DEVICE_TYPES, LOGGER, MANUFACTURER, DOMAIN, NAME, VERSION, STATE_UNKNOWN
@@ -8,6 +10,7 @@ from .const import DEVICE_TYPES, LOGGER, MANUFACTURER, DOMAIN, NAME, VERSION, ST
 class GroheEntity(CoordinatorEntity):
     def __init__(self, coordinator, device):
         super().__init__(coordinator)
+        self._device = device
         self._locationId = device.locationId
         self._roomId = device.roomId
         self._applianceId = device.applianceId
@@ -36,6 +39,16 @@ class GroheEntity(CoordinatorEntity):
             "integration": DOMAIN,
         }
 
+    @callback
+    def async_update_device(self, device):
+        """ Follows an appliance that moved to another location or room. The name is left alone, it is part of
+        the unique id of most entities. """
+        self._device = device._replace(name=self._device.name)
+        self._locationId = device.locationId
+        self._roomId = device.roomId
+        if self.hass is not None:
+            self.async_write_ha_state()
+
     def applianceId(self):
         """ returns the appliance Identifier, looks like a UUID, so hopefully unique """
         return self._applianceId
@@ -47,3 +60,18 @@ class GroheEntity(CoordinatorEntity):
 
     def _toCamelCase(self, word):
         return ' '.join(x.capitalize() or '_' for x in word.split('_'))
+
+
+@callback
+def async_retire_entities(hass, entities):
+    """ Removes entities of appliances that disappeared, including their entity registry entries.
+
+    Rediscovery drops the appliance's device from the device registry first, and the entity registry reacts by removing
+    the device's entries (and with them the entities) itself, so those that are already gone are skipped.
+    """
+    entity_registry = er.async_get(hass)
+    for entity in entities:
+        if entity.entity_id is not None and entity_registry.async_get(entity.entity_id) is not None:
+            entity_registry.async_remove(entity.entity_id)
+        elif entity.registry_entry is None:
+            hass.async_create_task(entity.async_remove(force_remove=True))
@@ -0,0 +1,141 @@
+"""Shared refresh schedule and aggregates across all Grohe Sense accounts."""
+from datetime import datetime
+
+from homeassistant.core import callback
+from homeassistant.helpers.event import async_call_later, async_track_time_interval
+
+from .const import GROHE_SENSE_GUARD_TYPE, LOGGER, NOTIFICATION_CATEGORY_CRITICAL, STATE_UNKNOWN, UPDATE_INTERVAL
+
+FLEET_TOTALS = ('consumption_today', 'open_valves', 'critical_notifications')
+
+
+def _entry_totals(coordinator):
+    """ What the appliances of one account add to the fleet totals """
+    since = datetime.now().astimezone().replace(hour=0, minute=0, second=0, microsecond=0)
+    totals = dict.fromkeys(FLEET_TOTALS, 0)
+    for device in coordinator.known_devices():
+        notifications = coordinator.active_notifications(device.applianceId)
+        totals['critical_notifications'] += sum(1 for n in notifications if n.get('category') == NOTIFICATION_CATEGORY_CRITICAL)
+        if device.type != GROHE_SENSE_GUARD_TYPE:
+            continue
+        consumption = coordinator.consumption(device.applianceId, since)
+        if consumption != STATE_UNKNOWN:
+            totals['consumption_today'] += consumption
+        if coordinator.valve_state(device.applianceId) is True:
+            totals['open_valves'] += 1
+    return totals
+
+
+class GroheFleet:
+    """ Runs the refreshes of every account that joined on one timer, and keeps totals over all of them.
+
+    Each tick spreads the refreshes evenly over the interval instead of letting every account's coordinator
+    fire on its own, so requests to the Grohe cloud come in small steady steps rather than bursts. Totals are
+    kept per account and only the account whose coordinator updated is recomputed.
+    """
+
+    def __init__(self, hass, interval=UPDATE_INTERVAL):
+        self._hass = hass
+        self._interval = interval
+        self._coordinators = {}  # entry_id -> coordinator
+        self._unsubscribe = {}  # entry_id -> removes the coordinator listener
+        self._entry_totals = {}  # entry_id -> totals of that account
+        self._platforms = {}  # entry_id -> async_add_entities of its sensor platform
+        self._sensor_owner = None
+        self._cancel_timer = None
+        self._pending = []  # Cancels the refreshes scheduled by the last tick
+        self._listeners = []
+        self.totals = dict.fromkeys(FLEET_TOTALS, 0)
+
+    def __contains__(self, entry_id):
+        return entry_id in self._coordinators
+
+    def __len__(self):
+        return len(self._coordinators)
+
+    @callback
+    def async_add(self, entry_id, coordinator):
+        """ Takes over the refresh schedule of the coordinator and starts counting it in the totals """
+        coordinator.update_interval = None
+        self._coordinators[entry_id] = coordinator
+        self._unsubscribe[entry_id] = coordinator.async_add_listener(lambda: self._async_entry_updated(entry_id))
+        self._async_entry_updated(entry_id)
+        if self._cancel_timer is None:
+            self._cancel_timer = async_track_time_interval(self._hass, self._async_tick, self._interval)
+        LOGGER.debug('Fleet now refreshes %d account(s)', len(self._coordinators))
+
+    @callback
+    def async_remove(self, entry_id):
+        """ Hands the coordinator back (it isn't refreshed anymore) and takes it out of the totals """
+        self._coordinators.pop(entry_id)
+        self._unsubscribe.pop(entry_id)()
+        self._async_set_entry_totals(entry_id, None)
+        self._platforms.pop(entry_id, None)
+        if self._sensor_owner == entry_id:
+            # The sensors went away with the platform of that account, another account's platform takes them over
+            self._sensor_owner = None
+            if self._platforms:
+                self._async_add_sensors(next(iter(self._platforms)))
+        if not self._coordinators:
+            self._cancel_timer()
+            self._cancel_timer = None
+            self._async_cancel_pending()
+
+    @callback
+    def async_add_platform(self, entry_id, async_add_entities, sensor_factory):
+        """ Registers the sensor platform of an account. The fleet sensors are added to one of them only. """
+        self._platforms[entry_id] = (async_add_entities, sensor_factory)
+        if self._sensor_owner is None:
+            self._async_add_sensors(entry_id)
+
+    @callback
+    def _async_add_sensors(self, entry_id):
+        async_add_entities, sensor_factory = self._platforms[entry_id]
+        self._sensor_owner = entry_id
+        async_add_entities([sensor_factory(self, key) for key in FLEET_TOTALS])
+
+    @callback
+    def async_add_listener(self, update_callback):
+        self._listeners.append(update_callback)
+
+        @callback
+        def remove_listener():
+            self._listeners.remove(update_callback)
+
+        return remove_listener
+
+    @callback
+    def _async_entry_updated(self, entry_id):
+        self._async_set_entry_totals(entry_id, _entry_totals(self._coordinators[entry_id]))
+
+    @callback
+    def _async_set_entry_totals(self, entry_id, totals):
+        previous = self._entry_totals.pop(entry_id, None)
+        if totals is not None:
+            self._entry_totals[entry_id] = totals
+        if previous == totals:
+            return
+        for key in FLEET_TOTALS:
+            self.totals[key] += (totals[key] if totals else 0) - (previous[key] if previous else 0)
+        for update_callback in list(self._listeners):
+            update_callback()
+
+    @callback
+    def _async_cancel_pending(self):
+        for cancel in self._pending:
+            cancel()
+        self._pending = []
+
+    @callback
+    def _async_tick(self, now=None):
+        self._async_cancel_pending()
+        step = self._interval.total_seconds() / len(self._coordinators)
+        for slot, entry_id in enumerate(self._coordinators):
+            self._pending.append(async_call_later(self._hass, slot * step, self._refresh_job(entry_id)))
+
+    def _refresh_job(self, entry_id):
+        async def async_refresh(now):
+            coordinator = self._coordinators.get(entry_id)
+            if coordinator is not None:
+                await coordinator.async_refresh()
+        return async_refresh
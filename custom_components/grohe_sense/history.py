@@ -0,0 +1,170 @@
+"""Paged, aggregated queries over the withdrawal and measurement history."""
+from __future__ import annotations
+
+import bisect
+from datetime import timedelta
+
+import voluptuous as vol
+
+from homeassistant.components import websocket_api
+from homeassistant.core import HomeAssistant, ServiceCall, ServiceResponse, SupportsResponse, callback
+from homeassistant.exceptions import HomeAssistantError
+import homeassistant.helpers.config_validation as cv
+from homeassistant.util import dt as dt_util
+
+from .const import (ATTR_AGGREGATE, ATTR_APPLIANCE_ID, ATTR_BUCKET, ATTR_END_TIME, ATTR_KEY, ATTR_KIND, ATTR_LIMIT,
+                    ATTR_OFFSET, ATTR_START_TIME, DOMAIN, HISTORY_PAGE_SIZE, HISTORY_MAX_PAGE_SIZE, SERVICE_GET_HISTORY,
+                    HISTORY_WITHDRAWAL_FIELDS)
+from .timeseries import floor_time
+
+KIND_WITHDRAWALS = 'withdrawals'
+KIND_MEASUREMENT = 'measurement'
+AGGREGATES = ('sum', 'mean', 'max')
+
+HISTORY_FIELDS = {
+    vol.Required(ATTR_APPLIANCE_ID): cv.string,
+    vol.Required(ATTR_KIND): vol.In([KIND_WITHDRAWALS, KIND_MEASUREMENT]),
+    vol.Optional(ATTR_KEY): cv.string,
+    vol.Optional(ATTR_START_TIME): cv.datetime,
+    vol.Optional(ATTR_END_TIME): cv.datetime,
+    vol.Optional(ATTR_BUCKET): vol.All(vol.Coerce(int), vol.Range(min=60)),
+    vol.Optional(ATTR_AGGREGATE): vol.In(AGGREGATES),
+    vol.Optional(ATTR_OFFSET, default=0): vol.All(vol.Coerce(int), vol.Range(min=0)),
+    vol.Optional(ATTR_LIMIT, default=HISTORY_PAGE_SIZE): vol.All(vol.Coerce(int), vol.Range(min=1, max=HISTORY_MAX_PAGE_SIZE)),
+}
+
+
+def _withdrawal_points(coordinator, applianceId, key, start, end):
+    if coordinator.data is None or applianceId not in coordinator.data:
+        return []
+    withdrawals = coordinator.data[applianceId]['withdrawals']  # Sorted by starttime
+    lo = 0 if start is None else bisect.bisect_left(withdrawals, start, key=lambda w: w['starttime'])
+    hi = len(withdrawals) if end is None else bisect.bisect_left(withdrawals, end, key=lambda w: w['starttime'])
+    return [{'time': w['starttime'], 'sum': w[key], 'max': w[key], 'count': 1}
+            for w in withdrawals[lo:hi] if key in w]
+
+
+def _measurement_points(coordinator, applianceId, key, start, end):
+    return [{'time': p['time'], 'sum': p['mean'] * p['count'], 'max': p['max'], 'count': p['count']}
+            for p in coordinator.measurement_series(applianceId, key, start, end)]
+
+
+def _aggregate(points, bucket):
+    buckets = {}
+    for point in points:
+        start = floor_time(point['time'], bucket)
+        aggregated = buckets.get(start)
+        if aggregated is None:
+            buckets[start] = dict(point, time=start)
+        else:
+            aggregated['sum'] += point['sum']
+            aggregated['max'] = max(aggregated['max'], point['max'])
+            aggregated['count'] += point['count']
+    return [buckets[start] for start in sorted(buckets)]
+
+
+def _defaults(kind, key, aggregate):
+    """ Withdrawals are summed per bucket by default, measurements averaged """
+    if kind == KIND_WITHDRAWALS:
+        return key or 'waterconsumption', aggregate or 'sum'
+    if key is None:
+        raise HomeAssistantError('A measurement key is required for measurement history')
+    return key, aggregate or 'mean'
+
+
+def query_history(coordinator, applianceId, kind, key=None, start=None, end=None, bucket=None, aggregate=None,
+                  offset=0, limit=HISTORY_PAGE_SIZE):
+    """ Returns a page of (optionally bucketed) history points for one appliance, from what the coordinator
+    keeps in memory. Without a bucket, every point (a withdrawal, or a raw or downsampled measurement) is
+    returned with the aggregate over just itself.
+    """
+    key, aggregate = _defaults(kind, key, aggregate)
+    if kind == KIND_WITHDRAWALS:
+        points = _withdrawal_points(coordinator, applianceId, key, start, end)
+    else:
+        points = _measurement_points(coordinator, applianceId, key, start, end)
+    return _page(points, applianceId, kind, key, bucket, aggregate, offset, limit)
+
+
+async def async_query_history(hass, coordinator, applianceId, kind, key=None, start=None, end=None, bucket=None,
+                              aggregate=None, offset=0, limit=HISTORY_PAGE_SIZE):
+    """ Like query_history, but from the history store when there is one, which goes back further: raw points
+    for the store's retention, daily aggregates before that """
+    if coordinator.history_store is None:
+        return query_history(coordinator, applianceId, kind, key, start, end, bucket, aggregate, offset, limit)
+    key, aggregate = _defaults(kind, key, aggregate)
+    if kind == KIND_WITHDRAWALS and key not in HISTORY_WITHDRAWAL_FIELDS:
+        raise HomeAssistantError(f'Withdrawal history is kept for {", ".join(HISTORY_WITHDRAWAL_FIELDS)}, not {key}')
+    points = await hass.async_add_executor_job(
+        coordinator.history_store.history_points, applianceId, kind, key, start, end)
+    return _page(points, applianceId, kind, key, bucket, aggregate, offset, limit)
+
+
+def _page(points, applianceId, kind, key, bucket, aggregate, offset, limit):
+    if bucket is not None:
+        points = _aggregate(points, bucket)
+
+    page = points[offset:offset + limit]
+    return {
+        'appliance_id': applianceId,
+        'kind': kind,
+        'key': key,
+        'aggregate': aggregate,
+        'total': len(points),
+        'next_offset': offset + limit if offset + limit < len(points) else None,
+        'points': [{'time': p['time'].isoformat(),
+                    'value': p['sum'] / p['count'] if aggregate == 'mean' else p[aggregate],
+                    'count': p['count']} for p in page],
+    }
+
+
+def _find_coordinator(hass, applianceId):
+    for coordinator in hass.data.get(DOMAIN, {}).values():
+        if any(device.applianceId == applianceId for device in coordinator.known_devices()):
+            return coordinator
+    raise HomeAssistantError(f'Unknown appliance {applianceId}')
+
+
+async def _async_query(hass, data):
+    return await async_query_history(
+        hass,
+        _find_coordinator(hass, data[ATTR_APPLIANCE_ID]),
+        data[ATTR_APPLIANCE_ID],
+        data[ATTR_KIND],
+        key=data.get(ATTR_KEY),
+        start=dt_util.as_utc(data[ATTR_START_TIME]) if ATTR_START_TIME in data else None,
+        end=dt_util.as_utc(data[ATTR_END_TIME]) if ATTR_END_TIME in data else None,
+        bucket=timedelta(seconds=data[ATTR_BUCKET]) if ATTR_BUCKET in data else None,
+        aggregate=data.get(ATTR_AGGREGATE),
+        offset=data[ATTR_OFFSET],
+        limit=data[ATTR_LIMIT],
+    )
+
+
+@websocket_api.websocket_command({vol.Required('type'): f'{DOMAIN}/history', **HISTORY_FIELDS})
+@websocket_api.async_response
+async def websocket_history(hass: HomeAssistant, connection: websocket_api.ActiveConnection, msg: dict) -> None:
+    """Return a page of history for an appliance."""
+    try:
+        result = await _async_query(hass, msg)
+    except HomeAssistantError as exception:
+        connection.send_error(msg['id'], websocket_api.ERR_NOT_FOUND, str(exception))
+        return
+    connection.send_result(msg['id'], result)
+
+
+@callback
+def async_setup_history(hass: HomeAssistant) -> None:
+    """Register the history websocket command and service."""
+
+    async def async_handle_get_history(call: ServiceCall) -> ServiceResponse:
+        return await _async_query(hass, call.data)
+
+    websocket_api.async_register_command(hass, websocket_history)
+    hass.services.async_register(
+        DOMAIN,
+        SERVICE_GET_HISTORY,
+        async_handle_get_history,
+        schema=vol.Schema(HISTORY_FIELDS),
+        supports_response=SupportsResponse.ONLY,
+    )
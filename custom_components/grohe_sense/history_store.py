@@ -0,0 +1,228 @@
+"""Durable on-disk history of withdrawals, measurements and poll watermarks."""
+import collections
+import json
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+from .const import (HISTORY_COMPACT_INTERVAL, HISTORY_MEASUREMENT_RETENTION, HISTORY_WITHDRAWAL_FIELDS,
+                    HISTORY_WITHDRAWAL_RETENTION, LOGGER)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS withdrawals (
+    appliance_id TEXT NOT NULL,
+    starttime REAL NOT NULL,
+    stoptime TEXT,
+    waterconsumption REAL,
+    maxflowrate REAL,
+    PRIMARY KEY (appliance_id, starttime)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS measurements (
+    appliance_id TEXT NOT NULL,
+    key TEXT NOT NULL,
+    time REAL NOT NULL,
+    value,
+    PRIMARY KEY (appliance_id, key, time)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS withdrawal_days (
+    appliance_id TEXT NOT NULL,
+    day TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    waterconsumption_sum REAL NOT NULL,
+    waterconsumption_max REAL,
+    maxflowrate_sum REAL NOT NULL,
+    maxflowrate_max REAL,
+    PRIMARY KEY (appliance_id, day)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS measurement_days (
+    appliance_id TEXT NOT NULL,
+    key TEXT NOT NULL,
+    day TEXT NOT NULL,
+    min REAL,
+    max REAL,
+    sum REAL NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (appliance_id, key, day)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS watermarks (
+    appliance_id TEXT PRIMARY KEY,
+    poll_from TEXT NOT NULL,
+    measurements TEXT NOT NULL
+);
+"""
+
+# Days are UTC days. The upserts need a WHERE on their SELECT, see "parsing ambiguity" in the SQLite UPSERT docs.
+COMPACT_WITHDRAWALS = """
+INSERT INTO withdrawal_days (appliance_id, day, count, waterconsumption_sum, waterconsumption_max, maxflowrate_sum,
+                             maxflowrate_max)
+SELECT appliance_id, date(starttime, 'unixepoch'), count(*), total(waterconsumption), max(waterconsumption),
+       total(maxflowrate), max(maxflowrate)
+FROM withdrawals WHERE starttime < ? GROUP BY 1, 2
+ON CONFLICT (appliance_id, day) DO UPDATE SET
+    count = count + excluded.count,
+    waterconsumption_sum = waterconsumption_sum + excluded.waterconsumption_sum,
+    waterconsumption_max = max(coalesce(waterconsumption_max, excluded.waterconsumption_max),
+                               coalesce(excluded.waterconsumption_max, waterconsumption_max)),
+    maxflowrate_sum = maxflowrate_sum + excluded.maxflowrate_sum,
+    maxflowrate_max = max(coalesce(maxflowrate_max, excluded.maxflowrate_max), coalesce(excluded.maxflowrate_max, maxflowrate_max))
+"""
+COMPACT_MEASUREMENTS = """
+INSERT INTO measurement_days (appliance_id, key, day, min, max, sum, count)
+SELECT appliance_id, key, date(time, 'unixepoch'), min(value), max(value), total(value), count(value)
+FROM measurements WHERE time < ? GROUP BY 1, 2, 3
+ON CONFLICT (appliance_id, key, day) DO UPDATE SET
+    min = min(coalesce(min, excluded.min), coalesce(excluded.min, min)),
+    max = max(coalesce(max, excluded.max), coalesce(excluded.max, max)),
+    sum = sum + excluded.sum,
+    count = count + excluded.count
+"""
+
+DAY_TIME = "(julianday(day) - 2440587.5) * 86400.0"  # Start of an aggregate's (UTC) day in epoch seconds
+
+
+def _from_timestamp(t):
+    return datetime.fromtimestamp(t, tz=timezone.utc)
+
+
+class HistoryStore:
+    """ SQLite database of what has been fetched per appliance, so a restart resumes instead of refetching.
+
+    Every method blocks, so they are meant to be called from an executor. The connection is opened on first
+    use and shared by the executor threads under a lock. Writes of one refresh go in a single transaction.
+    close() is final: jobs still running when the entry unloads fail instead of opening a connection again.
+    """
+
+    def __init__(self, path, withdrawal_retention=HISTORY_WITHDRAWAL_RETENTION,
+                 measurement_retention=HISTORY_MEASUREMENT_RETENTION, compact_interval=HISTORY_COMPACT_INTERVAL):
+        self.path = path
+        self._withdrawal_retention = withdrawal_retention
+        self._measurement_retention = measurement_retention
+        self._compact_interval = compact_interval
+        self._compacted_at = None
+        self._connection = None
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._closed:
+            raise sqlite3.ProgrammingError(f'History database {self.path} is closed')
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.executescript(SCHEMA)
+            LOGGER.debug('Opened history database %s', self.path)
+        return self._connection
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def load(self, windows):
+        """ Reads back what is needed to resume, for {applianceId: withdrawals since}.
+
+        Returns {applianceId: {'poll_from', 'measurements', 'withdrawals', 'series'}} for the appliances that have
+        a watermark. Withdrawals are dicts like parse_data_response returns, series (timestamp, {key: value}) samples.
+        """
+        with self._lock:
+            connection = self._connect()
+            history = {}
+            for applianceId, since in windows.items():
+                row = connection.execute('SELECT poll_from, measurements FROM watermarks WHERE appliance_id = ?',
+                                         (applianceId,)).fetchone()
+                if row is None:
+                    continue
+                withdrawals = []
+                for starttime, stoptime, waterconsumption, maxflowrate in connection.execute(
+                        'SELECT starttime, stoptime, waterconsumption, maxflowrate FROM withdrawals '
+                        'WHERE appliance_id = ? AND starttime >= ? ORDER BY starttime', (applianceId, since.timestamp())):
+                    withdrawal = {'starttime': _from_timestamp(starttime), 'stoptime': stoptime,
+                                  'waterconsumption': waterconsumption, 'maxflowrate': maxflowrate}
+                    withdrawals.append({field: value for field, value in withdrawal.items() if value is not None})
+                samples = collections.defaultdict(dict)
+                for t, key, value in connection.execute(
+                        'SELECT time, key, value FROM measurements WHERE appliance_id = ?', (applianceId,)):
+                    samples[t][key] = value
+                history[applianceId] = {
+                    'poll_from': datetime.fromisoformat(row[0]),
+                    'measurements': json.loads(row[1]),
+                    'withdrawals': withdrawals,
+                    'series': [(_from_timestamp(t), samples[t]) for t in sorted(samples)],
+                }
+            return history
+
+    def history_points(self, applianceId, kind, key, start=None, end=None):
+        """ Stored withdrawals or measurement samples of one key in [start, end), followed back in time by the daily
+        aggregates they were compacted into, oldest first, as dicts with time/sum/max/count """
+        if kind == 'withdrawals':
+            if key not in HISTORY_WITHDRAWAL_FIELDS:
+                raise ValueError(f'No history of withdrawal field {key}')
+            query = (f'SELECT starttime, {key}, {key}, 1 FROM withdrawals '
+                     f'WHERE appliance_id = ? AND {key} IS NOT NULL AND starttime >= ? AND starttime < ? '
+                     f'UNION ALL SELECT {DAY_TIME} AS t, {key}_sum, {key}_max, count FROM withdrawal_days '
+                     f'WHERE appliance_id = ? AND t >= ? AND t < ? ORDER BY 1')
+            args = ()
+        else:
+            query = ('SELECT time, value, value, 1 FROM measurements '
+                     'WHERE appliance_id = ? AND key = ? AND time >= ? AND time < ? '
+                     f'UNION ALL SELECT {DAY_TIME} AS t, sum, max, count FROM measurement_days '
+                     'WHERE appliance_id = ? AND key = ? AND t >= ? AND t < ? ORDER BY 1')
+            args = (key,)
+        window = (start.timestamp() if start is not None else float('-inf'),
+                  end.timestamp() if end is not None else float('inf'))
+        with self._lock:
+            rows = self._connect().execute(query, (applianceId, *args, *window) * 2).fetchall()
+        return [{'time': _from_timestamp(t), 'sum': total, 'max': maximum, 'count': count}
+                for t, total, maximum, count in rows]
+
+    def withdrawal_columns(self, applianceId, since):
+        """ Start times (epoch seconds), durations (seconds) and volumes of the stored withdrawals since, as
+        three lists. Durations come from sqlite's date functions, which understand Grohe's offset suffix. """
+        with self._lock:
+            rows = self._connect().execute(
+                'SELECT starttime, (julianday(stoptime) - 2440587.5) * 86400.0 - starttime, waterconsumption '
+                'FROM withdrawals WHERE appliance_id = ? AND starttime >= ? AND waterconsumption IS NOT NULL '
+                'ORDER BY starttime', (applianceId, since.timestamp())).fetchall()
+        return [list(column) for column in zip(*rows)] if rows else [[], [], []]
+
+    def save(self, batch, now):
+        """ Writes the new data of one refresh, [(applianceId, withdrawals, series, poll_from, measurements)], in one
+        transaction, then compacts what aged past retention if that hasn't been done for a while """
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                for applianceId, withdrawals, series, poll_from, measurements in batch:
+                    connection.executemany(
+                        'INSERT OR IGNORE INTO withdrawals VALUES (?, ?, ?, ?, ?)',
+                        [(applianceId, w['starttime'].timestamp(), w.get('stoptime'), w.get('waterconsumption'),
+                          w.get('maxflowrate')) for w in withdrawals])
+                    connection.executemany(
+                        'INSERT OR IGNORE INTO measurements VALUES (?, ?, ?, ?)',
+                        [(applianceId, key, t.timestamp(), value) for t, values in series for key, value in values.items()])
+                    connection.execute('INSERT OR REPLACE INTO watermarks VALUES (?, ?, ?)',
+                                       (applianceId, poll_from.isoformat(), json.dumps(measurements)))
+            if self._compacted_at is None or now - self._compacted_at >= self._compact_interval:
+                self._compact(connection, now)
+
+    def _compact(self, connection, now):
+        withdrawals_before = (now - self._withdrawal_retention).timestamp()
+        measurements_before = (now - self._measurement_retention).timestamp()
+        with connection:
+            connection.execute(COMPACT_WITHDRAWALS, (withdrawals_before,))
+            withdrawals = connection.execute('DELETE FROM withdrawals WHERE starttime < ?', (withdrawals_before,)).rowcount
+            connection.execute(COMPACT_MEASUREMENTS, (measurements_before,))
+            measurements = connection.execute('DELETE FROM measurements WHERE time < ?', (measurements_before,)).rowcount
+        self._compacted_at = now
+        LOGGER.debug('Compacted %d withdrawals and %d measurement samples into daily aggregates', withdrawals, measurements)
+
+    def remove(self, applianceIds):
+        """ Forgets everything stored about the appliances """
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                for table in ('withdrawals', 'measurements', 'withdrawal_days', 'measurement_days', 'watermarks'):
+                    connection.executemany(f'DELETE FROM {table} WHERE appliance_id = ?',
+                                           [(applianceId,) for applianceId in applianceIds])
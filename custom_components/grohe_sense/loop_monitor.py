@@ -0,0 +1,47 @@
+"""Detection of event loop blocking."""
+import asyncio
+import contextlib
+import time
+
+from .const import LOGGER, LOOP_LAG_INTERVAL, LOOP_LAG_LIMIT
+
+
+class EventLoopLagMonitor:
+    """ Measures how late the event loop wakes up a periodic sleeper, and how long sections of this integration
+    wrapped in timed() block it.
+
+    The sleeper catches blocking by anything on the loop, most likely not this integration, so it only logs at
+    debug level and one sleeper runs per Home Assistant instance. timed() names the section of this integration
+    that took longer than the limit, and warns.
+    """
+
+    def __init__(self, limit=LOOP_LAG_LIMIT, interval=LOOP_LAG_INTERVAL):
+        self.limit = limit
+        self._interval = interval
+        self.max_lag = 0.0
+        self.slow_count = 0
+
+    def stats(self):
+        return {'limit': self.limit, 'max_lag': self.max_lag, 'slow_count': self.slow_count}
+
+    async def async_run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self._interval)
+            lag = loop.time() - start - self._interval
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self.limit:
+                self.slow_count += 1
+                LOGGER.debug('Event loop was blocked for %.3fs (limit %.3fs)', lag, self.limit)
+
+    @contextlib.contextmanager
+    def timed(self, label):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            if elapsed > self.limit:
+                self.slow_count += 1
+                LOGGER.warning('%s blocked the event loop for %.3fs (limit %.3fs)', label, elapsed, self.limit)
@@ -0,0 +1,51 @@
+"""Incremental tracking of appliance notifications."""
+import collections
+
+from .const import NOTIFICATION_HISTORY_SIZE, NOTIFICATION_TYPES
+
+
+def notification_key(notification):
+    """ The notification id, or (category, type, timestamp) for responses that lack one """
+    if 'id' in notification:
+        return notification['id']
+    return (notification.get('category'), notification.get('type'), notification.get('timestamp'))
+
+
+def describe_notification(notification):
+    return NOTIFICATION_TYPES.get((notification.get('category'), notification.get('type')), 'Unknown notification: {}'.format(notification))
+
+
+class NotificationIndex:
+    """ Notifications of one appliance that have been seen, plus a bounded ring of the most recent ones.
+
+    The seen index only holds the notifications of the latest response and those still in the ring,
+    so it stays bounded however long the integration runs.
+    """
+
+    def __init__(self, size=NOTIFICATION_HISTORY_SIZE):
+        self._seen = {}  # notification key -> timestamp
+        self._seeded = False
+        self.recent = collections.deque(maxlen=size)
+        self.current = []
+        self.version = 0
+
+    def update(self, notifications):
+        """ Records a notifications response, returns the notifications not seen before (oldest first).
+
+        The first response only seeds the index, so notifications that were already there when
+        the integration started are not reported as new.
+        """
+        new = [n for n in notifications if notification_key(n) not in self._seen]
+        new.sort(key=lambda n: n.get('timestamp') or '')
+        self.recent.extend(new)
+
+        if new or len(notifications) != len(self.current):
+            self.version += 1
+        self.current = notifications
+        self._seen = {notification_key(n): n.get('timestamp') for n in self.recent}
+        self._seen.update((notification_key(n), n.get('timestamp')) for n in notifications)
+
+        if not self._seeded:
+            self._seeded = True
+            return []
+        return new
@@ -1,11 +1,26 @@
 
 import asyncio
+import json
 import re
 from lxml import html
 
-from .const import BASE_URL, GROHE_BASE_URL, LOGGER
+from .const import (BASE_URL, CONF_REFRESH_TOKEN, DEFAULT_REQUEST_BURST, DEFAULT_REQUEST_RATE, GROHE_BASE_URL, HTML_OFFLOAD_THRESHOLD,
+                    JSON_OFFLOAD_THRESHOLD, LOGGER, PRIORITY_AUTH, PRIORITY_COMMAND, PRIORITY_NOTIFICATION, PRIORITY_TELEMETRY)
+from .request_scheduler import RequestScheduler
+from .single_flight import SingleFlight
 
-_refresh_token = None
+try:
+    # Several times faster than the stdlib decoder on the large /data payloads, and shipped with Home Assistant
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+
+def _parse_login_form_action(text):
+    """ Returns the action url of the login form on the oidc login page """
+    tree = html.fromstring(text)
+    _name = tree.xpath("//html/body/div/div/div/div/div/div/div/form")
+    return _name[0].action
 
 
 class OauthException(Exception):
@@ -20,18 +35,43 @@ class TokenExpiredError(Exception):
 
 
 class OauthSession:
-    def __init__(self, session, data, username, password):
+    def __init__(self, session, data, username, password, request_rate=DEFAULT_REQUEST_RATE, request_burst=DEFAULT_REQUEST_BURST,
+                 decoder=json_loads, on_refresh_token=None):
         self._session = session
+        self._on_refresh_token = on_refresh_token
+        self._decoder = decoder
+        self._transfer_stats = {'responses': 0, 'compressed_responses': 0, 'unsized_responses': 0, 'wire_bytes': 0,
+                                'decoded_bytes': 0}
+        self._scheduler = RequestScheduler(request_rate, request_burst)
         self._access_token = None
-        self._fetching_new_token = None
+        self._fetching_new_token = SingleFlight('token refresh')
         self._username = username
         self._password = password
         self._data = data
+        self._refresh_token = data.get(CONF_REFRESH_TOKEN) if data else None
 
     @property
     def session(self):
         return self._session
 
+    @property
+    def scheduler(self):
+        return self._scheduler
+
+    @property
+    def transfer_stats(self):
+        """ Bytes received over the wire against bytes decoded as JSON. Both only count responses whose wire size
+        is known, the others (chunked without a raw byte count) are counted as unsized_responses. """
+        return dict(self._transfer_stats)
+
+    @property
+    def fetching_token(self):
+        return self._fetching_new_token
+
+    @property
+    def refresh_token(self):
+        return self._refresh_token
+
     async def get_locations(self):
         return await self.get(BASE_URL + f'locations')
 
@@ -44,15 +84,25 @@ class OauthSession:
     async def get_measurements_response(self, locationId, roomId, applianceId, poll_from):
         return await self.get(BASE_URL + f'locations/{locationId}/rooms/{roomId}/appliances/{applianceId}/data?from={poll_from}')
 
+    async def get_command(self, locationId, roomId, applianceId):
+        return await self.get(BASE_URL + f'locations/{locationId}/rooms/{roomId}/appliances/{applianceId}/command', priority=PRIORITY_COMMAND)
+
+    async def post_command(self, locationId, roomId, applianceId, command):
+        return await self.post(BASE_URL + f'locations/{locationId}/rooms/{roomId}/appliances/{applianceId}/command', command, priority=PRIORITY_COMMAND)
+
+    async def get_notifications(self, locationId, roomId, applianceId, page_size):
+        return await self.get(BASE_URL + f'locations/{locationId}/rooms/{roomId}/appliances/{applianceId}/notifications?pageSize={page_size}', priority=PRIORITY_NOTIFICATION)
+
     async def get(self, url, **kwargs):
         return await self._http_request(url, auth_token=self, **kwargs)
 
     async def post(self, url, _json, **kwargs):
         return await self._http_request(url, method='post', auth_token=self, json=_json, **kwargs)
 
-    async def _http_request(self, url, method='get', auth_token=None, headers=None, **kwargs):
+    async def _http_request(self, url, method='get', auth_token=None, headers=None, priority=PRIORITY_TELEMETRY, **kwargs):
         LOGGER.debug('Making http %s request to %s, headers %s', method, url, headers)
         headers = headers.copy() if headers is not None else {}
+        headers.setdefault('Accept-Encoding', 'gzip, deflate')
         tries = 0
 
         while True:
@@ -62,11 +112,12 @@ class OauthSession:
                 token = await auth_token.token()
                 headers['Authorization'] = token
 
+            await self._scheduler.acquire(priority)
             try:
                 async with self._session.request(method, url, headers=headers, **kwargs) as response:
                     LOGGER.debug('Http %s request to %s got response %d', method, url, response.status)
                     if response.status in (200, 201):
-                        return await response.json()
+                        return await self._decode_json(response)
                     elif response.status == 401:
                         if auth_token is not None:
                             LOGGER.debug('Request to %s returned status %d, refreshing auth token', url, response.status)
@@ -77,7 +128,7 @@ class OauthSession:
                             raise TokenExpiredError(await response.text())
                     else:
                         LOGGER.debug('Request to %s returned status %d, %s', url, response.status, await response.text())
-            except OauthException:
+            except (OauthException, TokenExpiredError):
                 raise
             except Exception as e:
                 LOGGER.debug('Exception for http %s request to %s: %s', method, url, e)
@@ -85,22 +136,63 @@ class OauthSession:
             tries += 1
             await asyncio.sleep(min(600, 2**tries))
 
+    async def _decode_json(self, response):
+        body = await response.read()
+        stats = self._transfer_stats
+        stats['responses'] += 1
+        if response.headers.get('Content-Encoding'):
+            stats['compressed_responses'] += 1
+        content_length = response.headers.get('Content-Length')
+        if content_length is not None:
+            wire_bytes = int(content_length)
+        else:
+            # Chunked responses have no Content-Length, newer aiohttp counts the raw bytes on the stream
+            wire_bytes = getattr(getattr(response, 'content', None), 'total_raw_bytes', None)
+        if wire_bytes is None:
+            stats['unsized_responses'] += 1
+        else:
+            stats['wire_bytes'] += wire_bytes
+            stats['decoded_bytes'] += len(body)
+
+        if not body.strip():
+            return None
+        if len(body) > JSON_OFFLOAD_THRESHOLD:
+            return await asyncio.get_running_loop().run_in_executor(None, self._decoder, body)
+        return self._decoder(body)
+
     async def token(self, old_token=None):
         """ Returns an authorization header. If one is supplied as old_token, invalidate that one """
 
         if self._access_token not in (None, old_token):
             return self._access_token
 
-        if self._fetching_new_token is not None:
-            await self._fetching_new_token.wait()
-            return self._access_token
+        return await self._fetching_new_token.run(self._fetch_new_token)
 
+    async def _fetch_new_token(self):
         self._access_token = None
-        self._fetching_new_token = asyncio.Event()
 
+        try:
+            refresh_response = await self._refresh_access_token()
+        except TokenExpiredError:
+            # The refresh token was rejected (e.g. an expired one handed over from the config flow), log in again
+            LOGGER.info('Refresh token was rejected, logging in again')
+            refresh_response = await self._refresh_access_token()
+
+        if not isinstance(refresh_response, dict) or 'access_token' not in refresh_response:
+            # Also an empty body, which _decode_json returns as None
+            LOGGER.warning('OAuth token refresh did not yield access token! Got back %s', refresh_response)
+            raise OauthException(500, 'Token refresh did not yield an access token')
+
+        if refresh_response.get('refresh_token') not in (None, self._refresh_token):
+            LOGGER.debug('Token refresh rotated the refresh token')
+            self._set_refresh_token(refresh_response['refresh_token'])
+
+        self._access_token = 'Bearer ' + refresh_response['access_token']
+        return self._access_token
+
+    async def _refresh_access_token(self):
         try:
             _refresh_token = await self.fetch_refresh_token()
-            LOGGER.error('refresh token %s',  _refresh_token)
         except Exception as e:
             LOGGER.error('Exception when fetching refresh token: %s', e)
             raise OauthException(500, 'Error when fetching refresh token')
@@ -108,42 +200,40 @@ class OauthSession:
         data = {'refresh_token': _refresh_token}
         headers = {'Content-Type': 'application/json'}
 
-        refresh_response = await self._http_request(BASE_URL + 'oidc/refresh', 'post', headers=headers, json=data)
-        if not 'access_token' in refresh_response:
-            LOGGER.warning('OAuth token refresh did not yield access token! Got back %s', refresh_response)
-        else:
-            self._access_token = 'Bearer ' + refresh_response['access_token']
+        return await self._http_request(BASE_URL + 'oidc/refresh', 'post', headers=headers, priority=PRIORITY_AUTH, json=data)
 
-        self._fetching_new_token.set()
-        self._fetching_new_token = None
+    def _clear_refresh_token(self):
+        self._refresh_token = None
 
-        return self._access_token
-
-    async def _clear_refresh_token(self):
-        global _refresh_token
-        _refresh_token = None
+    def _set_refresh_token(self, refresh_token):
+        """ Keeps a new refresh token, and hands it to on_refresh_token so it can be stored """
+        self._refresh_token = refresh_token
+        if self._on_refresh_token is not None:
+            self._on_refresh_token(refresh_token)
 
     async def fetch_refresh_token(self):
         """ Fetch refresh token """
-        global _refresh_token
 
-        if _refresh_token is None:
+        if self._refresh_token is None:
             LOGGER.debug('No refresh token found, fetching refresh token')
-            _refresh_token = await self._get_refresh_token(self._username, self._password)
+            self._set_refresh_token(await self._get_refresh_token(self._username, self._password))
 
-        return _refresh_token
+        return self._refresh_token
 
     async def _get_refresh_token(self, username, password):
         _cookie = None
         _json = None
         _ondus_url = None
 
+        await self._scheduler.acquire(PRIORITY_AUTH)
         async with self._session.request('get', BASE_URL + 'oidc/login') as response:
             _cookie = response.cookies
             _text = await response.text()
-            tree = html.fromstring(_text)
-            _name = tree.xpath("//html/body/div/div/div/div/div/div/div/form")
-            _action = _name[0].action
+
+        if len(_text) > HTML_OFFLOAD_THRESHOLD:
+            _action = await asyncio.get_running_loop().run_in_executor(None, _parse_login_form_action, _text)
+        else:
+            _action = _parse_login_form_action(_text)
 
         _payload = {'username': username,
                     'password': password,
@@ -152,9 +242,11 @@ class OauthSession:
                     'referer': BASE_URL + 'oidc/login',
                     'X-Requested-With': 'XMLHttpRequest'}
 
+        await self._scheduler.acquire(PRIORITY_AUTH)
         async with self._session.request('post', url=_action, data=_payload, cookies=_cookie, allow_redirects=False) as response:
             _ondus_url = response.headers['location'].replace('ondus', 'https')
 
+        await self._scheduler.acquire(PRIORITY_AUTH)
         async with self._session.request('get', _ondus_url, cookies=_cookie) as response:
             _json = await response.json()
 
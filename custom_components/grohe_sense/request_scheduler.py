@@ -0,0 +1,84 @@
+"""Prioritised, rate limited scheduling of requests to the Grohe API."""
+import asyncio
+import heapq
+import itertools
+import time
+
+from .const import (DEFAULT_REQUEST_BURST, DEFAULT_REQUEST_RATE, LOGGER, PRIORITY_AUTH, PRIORITY_COMMAND,
+                    PRIORITY_NOTIFICATION, PRIORITY_TELEMETRY)
+
+PRIORITY_NAMES = {
+    PRIORITY_AUTH: 'auth',
+    PRIORITY_COMMAND: 'command',
+    PRIORITY_TELEMETRY: 'telemetry',
+    PRIORITY_NOTIFICATION: 'notification',
+}
+
+
+class RequestScheduler:
+    """ Token bucket shared by all requests of one account.
+
+    Requests acquire a slot before going out. While tokens are available and nobody is queued, a slot is
+    granted immediately; otherwise the request is queued and slots are handed out by priority (lower value
+    first, FIFO within a priority) at the configured rate.
+    """
+
+    def __init__(self, rate=DEFAULT_REQUEST_RATE, burst=DEFAULT_REQUEST_BURST):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._queue = []
+        self._sequence = itertools.count()
+        self._dispatcher = None
+        self._max_queue_depth = 0
+
+    @property
+    def queue_depth(self):
+        """ Number of requests currently waiting for a slot """
+        return sum(1 for _, _, waiter in self._queue if not waiter.done())
+
+    def stats(self):
+        depth_per_priority = dict.fromkeys(PRIORITY_NAMES.values(), 0)
+        for priority, _, waiter in self._queue:
+            if not waiter.done():
+                name = PRIORITY_NAMES.get(priority, str(priority))
+                depth_per_priority[name] = depth_per_priority.get(name, 0) + 1
+        return {
+            'queue_depth': sum(depth_per_priority.values()),
+            'queue_depth_per_priority': depth_per_priority,
+            'max_queue_depth': self._max_queue_depth,
+            'tokens': self._tokens,
+        }
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    async def acquire(self, priority=PRIORITY_TELEMETRY):
+        """ Waits until a request of the given priority may be sent """
+        self._refill()
+        if not self._queue and self._tokens >= 1:
+            self._tokens -= 1
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._sequence), waiter))
+        self._max_queue_depth = max(self._max_queue_depth, len(self._queue))
+        LOGGER.debug('Queued %s request, %d request(s) waiting', PRIORITY_NAMES.get(priority, priority), len(self._queue))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.get_running_loop().create_task(self._dispatch())
+        await waiter
+
+    async def _dispatch(self):
+        while self._queue:
+            self._refill()
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self._rate)
+                continue
+            _, _, waiter = heapq.heappop(self._queue)
+            if waiter.done():  # Cancelled while waiting, doesn't get a token
+                continue
+            self._tokens -= 1
+            waiter.set_result(None)
@@ -1,13 +1,16 @@
 
 from datetime import (datetime, timezone, timedelta)
-from .const import LOGGER, DOMAIN, BASE_URL, NOTIFICATION_TYPES, NOTIFICATION_UPDATE_DELAY, SENSOR_TYPES, SENSOR_TYPES_PER_UNIT, GROHE_SENSE_GUARD_TYPE
+from .const import (LOGGER, DOMAIN, NOTIFICATION_UPDATE_DELAY, SENSOR_TYPES, SENSOR_TYPES_PER_UNIT, GROHE_SENSE_GUARD_TYPE,
+                    FLEET_DATA)
 
-from homeassistant.helpers.entity import DeviceInfo
+from homeassistant.core import callback
+from homeassistant.helpers.entity import DeviceInfo, Entity
 from homeassistant.util import Throttle
 from homeassistant.const import (STATE_UNAVAILABLE, STATE_UNKNOWN, VOLUME_LITERS)
 from homeassistant.helpers import aiohttp_client
 
-from .entity import GroheEntity
+from .entity import GroheEntity, async_retire_entities
+from .notifications import describe_notification
 
 
 MANUFACTURER = "Grohe"
@@ -16,31 +19,53 @@ MANUFACTURER = "Grohe"
 async def async_setup_entry(hass, entry, async_add_devices):
     LOGGER.debug("Starting Grohe Sense sensor")
 
-    entities = []
     coordinator = hass.data[DOMAIN][entry.entry_id]
-    devices = await coordinator.get_devices()
-    for device in devices:
-        entities.append(GroheSenseNotificationEntity(coordinator, device))
-        if device.type in SENSOR_TYPES_PER_UNIT:
-            entities += [GroheSenseSensorEntity(coordinator, device, key) for key in SENSOR_TYPES_PER_UNIT[device.type]]
-            if device.type == GROHE_SENSE_GUARD_TYPE:  # The sense guard also gets sensor entities for water flow
-                entities.append(GroheSenseGuardWithdrawalsEntity(coordinator, device, 1))
-                entities.append(GroheSenseGuardWithdrawalsEntity(coordinator, device, 7))
-        else:
-            LOGGER.warning('Unrecognized appliance %s, ignoring.', device)
-    if entities:
-        async_add_devices(entities)
+    entities_per_appliance = {}
+
+    @callback
+    def async_add_appliances(devices):
+        entities = []
+        for device in devices:
+            device_entities = [GroheSenseNotificationEntity(coordinator, device)]
+            if device.type in SENSOR_TYPES_PER_UNIT:
+                device_entities += [GroheSenseSensorEntity(coordinator, device, key) for key in SENSOR_TYPES_PER_UNIT[device.type]]
+                if device.type == GROHE_SENSE_GUARD_TYPE:  # The sense guard also gets sensor entities for water flow
+                    device_entities.append(GroheSenseGuardWithdrawalsEntity(coordinator, device, 1))
+                    device_entities.append(GroheSenseGuardWithdrawalsEntity(coordinator, device, 7))
+                    device_entities.append(GroheSenseGuardUsageProfileEntity(coordinator, device))
+            else:
+                LOGGER.warning('Unrecognized appliance %s, ignoring.', device)
+            entities_per_appliance[device.applianceId] = device_entities
+            entities += device_entities
+        if entities:
+            async_add_devices(entities)
+
+    @callback
+    def async_devices_changed(added, removed):
+        # Appliances that moved or were renamed are in both lists, their entities are kept and updated in place
+        moved = {device.applianceId: device for device in added if device.applianceId in entities_per_appliance}
+        async_retire_entities(hass, [entity for device in removed if device.applianceId not in moved
+                                     for entity in entities_per_appliance.pop(device.applianceId, [])])
+        for applianceId, device in moved.items():
+            for entity in entities_per_appliance[applianceId]:
+                entity.async_update_device(device)
+        async_add_appliances([device for device in added if device.applianceId not in moved])
+
+    async_add_appliances(await coordinator.get_devices())
+    entry.async_on_unload(coordinator.async_add_device_listener(async_devices_changed))
+
+    fleet = hass.data.get(FLEET_DATA)
+    if fleet is not None and entry.entry_id in fleet:
+        fleet.async_add_platform(entry.entry_id, async_add_devices, GroheFleetSensorEntity)
 
 
 class GroheSenseNotificationEntity(GroheEntity):
     def __init__(self, coordinator, device):
         super().__init__(coordinator, device)
-        self._auth_session = coordinator.client
-        self._locationId = device.locationId
-        self._roomId = device.roomId
-        self._applianceId = device.applianceId
         self._name = device.name
-        self._notifications = []
+        self._notifications_version = None
+        self._state = ''
+        self._recent = []
 
     @property
     def unique_id(self):
@@ -51,17 +76,32 @@ class GroheSenseNotificationEntity(GroheEntity):
     def name(self):
         return 'Notifications'
 
+    @property
+    def should_poll(self):
+        # Notifications are fetched by the entity itself rather than by the coordinator refresh
+        return True
+
     @property
     def state(self):
+        return self._state
+
+    @property
+    def extra_state_attributes(self):
+        return {'recent': self._recent}
+
+    @Throttle(NOTIFICATION_UPDATE_DELAY)
+    async def async_update(self):
         def truncate_string(l, s):
             if len(s) > l:
                 return s[:l-4] + ' ...'
             return s
-        return truncate_string(255, '\n'.join([NOTIFICATION_TYPES.get((n['category'], n['type']), 'Unknown notification: {}'.format(n)) for n in self._notifications]))
 
-    @Throttle(NOTIFICATION_UPDATE_DELAY)
-    async def async_update(self):
-        self._notifications = await self._auth_session.get(BASE_URL + f'locations/{self._locationId}/rooms/{self._roomId}/appliances/{self._applianceId}/notifications')
+        index = await self.coordinator.async_get_notifications(self._device)
+        if index.version == self._notifications_version:  # Nothing new, keep what was rendered last time
+            return
+        self._notifications_version = index.version
+        self._state = truncate_string(255, '\n'.join([describe_notification(n) for n in index.current]))
+        self._recent = [{'notification': describe_notification(n), 'timestamp': n.get('timestamp')} for n in index.recent]
 
 
 class GroheSenseGuardWithdrawalsEntity(GroheEntity):
@@ -91,6 +131,36 @@ class GroheSenseGuardWithdrawalsEntity(GroheEntity):
         return self.coordinator.consumption(self._applianceId, since)
 
 
+class GroheSenseGuardUsageProfileEntity(GroheEntity):
+    """ The consumption of a typical day as state, the rest of the usage profile as attributes """
+
+    def __init__(self, coordinator, device):
+        super().__init__(coordinator, device)
+        self._name = device.name
+
+    @property
+    def unique_id(self):
+        return '{}-usage-profile'.format(self._name)
+
+    @property
+    def name(self):
+        return 'Typical daily consumption'
+
+    @property
+    def unit_of_measurement(self):
+        return VOLUME_LITERS
+
+    @property
+    def state(self):
+        profile = self.coordinator.usage_profile(self._applianceId)
+        return profile['typical_day'] if profile is not None else STATE_UNKNOWN
+
+    @property
+    def extra_state_attributes(self):
+        profile = self.coordinator.usage_profile(self._applianceId)
+        return {key: value for key, value in profile.items() if key != 'typical_day'} if profile is not None else {}
+
+
 class GroheSenseSensorEntity(GroheEntity):
     def __init__(self, coordinator, device, key):
         super().__init__(coordinator, device)
@@ -121,3 +191,38 @@ class GroheSenseSensorEntity(GroheEntity):
             return raw_state
         else:
             return SENSOR_TYPES[self._key].function(raw_state)
+
+
+class GroheFleetSensorEntity(Entity):
+    """ A total over the appliances of every account in the fleet """
+    _attr_should_poll = False
+
+    NAMES = {
+        'consumption_today': 'Grohe total consumption today',
+        'open_valves': 'Grohe open valves',
+        'critical_notifications': 'Grohe critical notifications',
+    }
+
+    def __init__(self, fleet, key):
+        self._fleet = fleet
+        self._key = key
+
+    async def async_added_to_hass(self):
+        self.async_on_remove(self._fleet.async_add_listener(self.async_write_ha_state))
+
+    @property
+    def unique_id(self):
+        return '{}-fleet-{}'.format(DOMAIN, self._key)
+
+    @property
+    def name(self):
+        return self.NAMES[self._key]
+
+    @property
+    def unit_of_measurement(self):
+        return VOLUME_LITERS if self._key == 'consumption_today' else None
+
+    @property
+    def state(self):
+        value = self._fleet.totals[self._key]
+        return round(value, 2) if self._key == 'consumption_today' else value
@@ -0,0 +1,53 @@
+"""Coalescing of concurrent calls into a single execution."""
+import asyncio
+
+from .const import LOGGER
+
+
+class SingleFlight:
+    """ Runs at most one call at a time; callers arriving while it runs wait for that call instead of starting their own.
+
+    The result, or the exception, of the call is passed to every waiting caller, and the next caller after
+    it finished starts a new call, so a failing call never leaves later callers waiting forever. A caller
+    that times out or is cancelled only stops waiting; the call itself is cancelled once the last caller
+    waiting for it is cancelled.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._task = None
+        self._waiters = {}  # task -> number of callers waiting for it
+        self.calls = 0
+        self.coalesced = 0
+
+    def stats(self):
+        return {'calls': self.calls, 'coalesced': self.coalesced}
+
+    async def run(self, func, *args, timeout=None):
+        self.calls += 1
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(func(*args))
+            self._task.add_done_callback(self._done)
+        else:
+            self.coalesced += 1
+            LOGGER.debug('Joining %s already in flight', self._name)
+
+        task = self._task
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), timeout)
+        except asyncio.CancelledError:
+            if self._waiters.get(task) == 1 and not task.done():
+                LOGGER.debug('Cancelling %s, nobody is waiting for it anymore', self._name)
+                task.cancel()
+            raise
+        finally:
+            if task in self._waiters:
+                self._waiters[task] -= 1
+
+    def _done(self, task):
+        if self._task is task:
+            self._task = None
+        self._waiters.pop(task, None)
+        if not task.cancelled():
+            task.exception()  # Retrieved here too, so an exception nobody waited for isn't logged as never retrieved
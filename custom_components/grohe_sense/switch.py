@@ -1,51 +1,66 @@
-from .const import DOMAIN, BASE_URL, GROHE_SENSE_GUARD_TYPE, GROHE_BLUE_HOME_TYPE, LOGGER
+from .const import DOMAIN, GROHE_SENSE_GUARD_TYPE, LOGGER
 from homeassistant.const import (STATE_UNKNOWN)
+from homeassistant.core import callback
 from homeassistant.util import Throttle
 from homeassistant.components.switch import SwitchEntity
 from datetime import (timedelta)
 
+from .entity import GroheEntity, async_retire_entities
+
 
 VALVE_UPDATE_DELAY = timedelta(minutes=1)
 
 
-async def async_setup_platform(hass, config, async_add_entities, discovery_info=None):
+async def async_setup_entry(hass, entry, async_add_entities):
     LOGGER.debug("Starting Grohe Sense valve switch")
-    auth_session = hass.data[DOMAIN]['session']
-    entities = []
-
-    for device in filter(lambda d: d.type == GROHE_SENSE_GUARD_TYPE, hass.data[DOMAIN]['devices']):
-        entities.append(GroheSenseGuardValve(auth_session, device.locationId, device.roomId, device.applianceId, device.name))
-    if entities:
-        async_add_entities(entities)
-
-
-async def async_setup_platform(hass, config, async_add_entities, discovery_info=None):
-    LOGGER.debug("Starting Grohe Blue Home tap")
-    auth_session = hass.data[DOMAIN]['session']
-    entities = []
+    coordinator = hass.data[DOMAIN][entry.entry_id]
+    entities_per_appliance = {}
+
+    @callback
+    def async_add_appliances(devices):
+        entities = []
+        for device in devices:
+            # Only sense guard valves. GroheBlueHomeTap dispenses water on both turn_on and turn_off, so it isn't set up.
+            if device.type == GROHE_SENSE_GUARD_TYPE:
+                entities_per_appliance[device.applianceId] = GroheSenseGuardValve(coordinator, device)
+                entities.append(entities_per_appliance[device.applianceId])
+        if entities:
+            async_add_entities(entities)
+
+    @callback
+    def async_devices_changed(added, removed):
+        # Appliances that moved or were renamed are in both lists, their entities are kept and updated in place
+        moved = {device.applianceId: device for device in added if device.applianceId in entities_per_appliance}
+        async_retire_entities(hass, [entities_per_appliance.pop(device.applianceId) for device in removed
+                                     if device.applianceId in entities_per_appliance and device.applianceId not in moved])
+        for applianceId, device in moved.items():
+            entities_per_appliance[applianceId].async_update_device(device)
+        async_add_appliances([device for device in added if device.applianceId not in moved])
+
+    async_add_appliances(await coordinator.get_devices())
+    entry.async_on_unload(coordinator.async_add_device_listener(async_devices_changed))
+
+
+class GroheSenseGuardValve(GroheEntity, SwitchEntity):
+    """ The valve state lives in the coordinator, so valve services and other entities see the same state """
 
-    for device in filter(lambda d: d.type == GROHE_BLUE_HOME_TYPE, hass.data[DOMAIN]['devices']):
-        entities.append(GroheBlueHomeTap(auth_session, device.locationId, device.roomId, device.applianceId, device.name))
-    if entities:
-        async_add_entities(entities)
-
-
-class GroheSenseGuardValve(SwitchEntity):
-    def __init__(self, auth_session, locationId, roomId, applianceId, name):
-        self._auth_session = auth_session
-        self._locationId = locationId
-        self._roomId = roomId
-        self._applianceId = applianceId
-        self._name = name
-        self._is_on = STATE_UNKNOWN
+    @property
+    def unique_id(self):
+        return '{}-valve'.format(self._applianceId)
 
     @property
     def name(self):
         return '{} valve'.format(self._name)
 
+    @property
+    def should_poll(self):
+        # The valve state isn't part of the /data response, it's read back from /command by the entity itself
+        return True
+
     @property
     def is_on(self):
-        return self._is_on
+        valve_open = self.coordinator.valve_state(self._applianceId)
+        return valve_open if isinstance(valve_open, bool) else None
 
     @property
     def icon(self):
@@ -57,27 +72,15 @@ class GroheSenseGuardValve(SwitchEntity):
 
     @Throttle(VALVE_UPDATE_DELAY)
     async def async_update(self):
-        command_response = await self._auth_session.get(BASE_URL + f'locations/{self._locationId}/rooms/{self._roomId}/appliances/{self._applianceId}/command')
-        if 'command' in command_response and 'valve_open' in command_response['command']:
-            self._is_on = command_response['command']['valve_open']
-        else:
-            LOGGER.error('Failed to parse out valve_open from commands response: %s', command_response)
-
-    async def _set_state(self, state):
-        data = {'type': GROHE_SENSE_GUARD_TYPE, 'command': {'valve_open': state}}
-        command_response = await self._auth_session.post(BASE_URL + f'locations/{self._locationId}/rooms/{self._roomId}/appliances/{self._applianceId}/command', data)
-        if 'command' in command_response and 'valve_open' in command_response['command']:
-            self._is_on = command_response['command']['valve_open']
-        else:
-            LOGGER.warning('Got unknown response back when setting valve state: %s', command_response)
+        await self.coordinator.async_get_valve(self._device)
 
     async def async_turn_on(self, **kwargs):
         LOGGER.info('Turning on water for %s', self._name)
-        await self._set_state(True)
+        await self.coordinator.async_set_valve(self._device, True)
 
     async def async_turn_off(self, **kwargs):
         LOGGER.info('Turning off water for %s', self._name)
-        await self._set_state(False)
+        await self.coordinator.async_set_valve(self._device, False)
 
 
 class GroheBlueHomeTap(SwitchEntity):
@@ -107,7 +110,7 @@ class GroheBlueHomeTap(SwitchEntity):
 
     @Throttle(VALVE_UPDATE_DELAY)
     async def async_update(self):
-        command_response = await self._auth_session.get(BASE_URL + f'locations/{self._locationId}/rooms/{self._roomId}/appliances/{self._applianceId}/command')
+        command_response = await self._auth_session.get_command(self._locationId, self._roomId, self._applianceId)
         if 'command' in command_response and 'valve_open' in command_response['command']:
             self._is_on = command_response['command']['valve_open']
         else:
@@ -116,7 +119,7 @@ class GroheBlueHomeTap(SwitchEntity):
 
     async def _set_state(self, state):
         data = {'command': {'tap_type': 1, "tap_amount": 20}}
-        command_response = await self._auth_session.post(BASE_URL + f'locations/{self._locationId}/rooms/{self._roomId}/appliances/{self._applianceId}/command', data)
+        command_response = await self._auth_session.post_command(self._locationId, self._roomId, self._applianceId, data)
         if 'command' in command_response and 'valve_open' in command_response['command']:
             self._is_on = command_response['command']['valve_open']
         else:
@@ -0,0 +1,186 @@
+"""Synthetic large-fleet load test.
+
+Simulates many appliances across many locations and rooms behind a local fake of the Grohe API, drives
+GroheDataUpdateCoordinator plus all sensor and switch entities for a number of refresh cycles, and fails
+when event loop lag, peak memory or per-refresh CPU time exceed their budgets.
+
+Run from the Home Assistant config dir (or anywhere custom_components is importable):
+
+    python -m custom_components.grohe_sense.test.load_test --locations 20 --rooms 5 --appliances 3
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+
+from homeassistant.core import HomeAssistant
+
+from .. import sensor, switch
+from ..const import BASE_URL, DOMAIN, GROHE_BLUE_HOME_TYPE, GROHE_SENSE_GUARD_TYPE, GROHE_SENSE_TYPE
+from ..coordinator import GroheDataUpdateCoordinator
+from ..loop_monitor import EventLoopLagMonitor
+from ..oauth_session import OauthSession
+
+SAMPLE_INTERVAL = timedelta(minutes=15)  # Sense Guard upload interval
+CYCLE_INTERVAL = timedelta(minutes=5)  # Simulated time between refresh cycles
+TZ = timezone(timedelta(hours=2))  # Grohe reports local time with an offset
+
+
+def grohe_time(t):
+    return t.astimezone(TZ).isoformat(timespec='milliseconds')
+
+
+class FakeResponse:
+    def __init__(self, status, payload):
+        self.status = status
+        self._payload = payload
+        self.headers = {}
+        self.cookies = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+    async def read(self):
+        return json.dumps(self._payload).encode()
+
+    async def text(self):
+        return json.dumps(self._payload)
+
+
+class FakeGroheApi:
+    """ Stands in for the aiohttp session, answering like the Grohe cloud for a synthetic fleet """
+
+    def __init__(self, locations, rooms, appliances):
+        types = itertools.cycle([GROHE_SENSE_GUARD_TYPE, GROHE_SENSE_TYPE, GROHE_BLUE_HOME_TYPE])
+        self.topology = {
+            f'location-{l}': {
+                f'room-{l}-{r}': [
+                    {'appliance_id': f'appliance-{l}-{r}-{a}', 'type': next(types), 'name': f'Appliance {l}-{r}-{a}'}
+                    for a in range(appliances)]
+                for r in range(rooms)}
+            for l in range(locations)}
+        self.appliance_types = {appliance['appliance_id']: appliance['type']
+                                for rooms in self.topology.values() for appliance_list in rooms.values() for appliance in appliance_list}
+        self.now = datetime.now(tz=timezone.utc)
+        self.requests = 0
+
+    def advance(self, delta):
+        self.now += delta
+
+    def request(self, method, url, headers=None, **kwargs):
+        self.requests += 1
+        parsed = urlparse(url)
+        parts = parsed.path[len(urlparse(BASE_URL).path):].strip('/').split('/')
+        if parts == ['locations']:
+            payload = [{'id': location} for location in self.topology]
+        elif len(parts) == 3 and parts[2] == 'rooms':
+            payload = [{'id': room} for room in self.topology[parts[1]]]
+        elif len(parts) == 5 and parts[4] == 'appliances':
+            payload = self.topology[parts[1]][parts[3]]
+        elif len(parts) == 7 and parts[6] == 'data':
+            poll_from = datetime.strptime(parse_qs(parsed.query)['from'][0], '%Y-%m-%d').replace(tzinfo=timezone.utc)
+            payload = self._data(self.appliance_types[parts[5]], poll_from)
+        elif len(parts) == 7 and parts[6] == 'notifications':
+            payload = [{'id': f'{parts[5]}-{n}', 'category': 20, 'type': 320, 'timestamp': grohe_time(self.now)} for n in range(3)]
+        elif len(parts) == 7 and parts[6] == 'command':
+            payload = {'command': {'valve_open': True}}
+        else:
+            return FakeResponse(404, {})
+        return FakeResponse(200, payload)
+
+    def _data(self, appliance_type, poll_from):
+        """ Everything from the start of the requested day up to now, like the real /data endpoint """
+        steps = int((self.now - poll_from) / SAMPLE_INTERVAL)
+        times = [poll_from + i * SAMPLE_INTERVAL for i in range(steps)]
+        if appliance_type == GROHE_SENSE_GUARD_TYPE:
+            return {'data': {
+                'withdrawals': [{'starttime': grohe_time(t), 'stoptime': grohe_time(t + timedelta(minutes=2)),
+                                 'waterconsumption': 4.2, 'maxflowrate': 0.1, 'hotwater_share': 0, 'water_cost': 0,
+                                 'energy_cost': 0} for t in times],
+                'measurement': [{'timestamp': grohe_time(t), 'flowrate': 0.1, 'pressure': 3.2, 'temperature_guard': 14.5}
+                                for t in times],
+            }}
+        if appliance_type == GROHE_SENSE_TYPE:
+            return {'data': {'measurement': [{'timestamp': grohe_time(t), 'temperature': 21.0, 'humidity': 45}
+                                             for t in times[::4]]}}
+        return {'data': {'measurement': [{'timestamp': grohe_time(t), 'open_close_cycles_still': i, 'remaining_filter': 80}
+                                         for i, t in enumerate(times)]}}
+
+
+async def run(args):
+    api = FakeGroheApi(args.locations, args.rooms, args.appliances)
+    hass = HomeAssistant(tempfile.mkdtemp())
+    client = OauthSession(session=api, data={}, username='load-test', password='load-test',
+                          request_rate=args.request_rate, request_burst=args.request_rate)
+    client._access_token = 'Bearer load-test'
+    coordinator = GroheDataUpdateCoordinator(hass=hass, client=client)
+
+    entry = SimpleNamespace(entry_id='load-test', async_on_unload=lambda func: None)
+    hass.data[DOMAIN] = {entry.entry_id: coordinator}
+    entities = []
+    await sensor.async_setup_entry(hass, entry, entities.extend)
+    await switch.async_setup_entry(hass, entry, entities.extend)
+    print(f'{len(api.appliance_types)} appliances, {len(entities)} entities, {api.requests} discovery requests')
+
+    monitor = EventLoopLagMonitor(args.max_loop_lag, interval=0.01)
+    monitor_task = asyncio.get_running_loop().create_task(monitor.async_run())
+    tracemalloc.start()
+    cpu_times = []
+    try:
+        for cycle in range(args.cycles):
+            api.advance(CYCLE_INTERVAL)
+            coordinator._data_fetch_completed = datetime.min  # Don't let the 5 minute guard skip cycles
+            cpu_start = time.process_time()
+            await coordinator.async_refresh()
+            for entity in entities:
+                if entity.should_poll:  # Coordinator entities are updated by the refresh itself
+                    await entity.async_update(no_throttle=True)
+                entity.state
+            cpu_times.append(time.process_time() - cpu_start)
+            if not coordinator.last_update_success:
+                print(f'Refresh {cycle} failed: {coordinator.last_exception}')
+                return 1
+    finally:
+        peak_memory = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+        monitor_task.cancel()
+
+    results = {
+        'max event loop lag (s)': (monitor.max_lag, args.max_loop_lag),
+        'peak memory (MiB)': (peak_memory, args.max_memory),
+        'max refresh cpu (s)': (max(cpu_times), args.max_refresh_cpu),
+    }
+    print(f'{args.cycles} refresh cycles, {api.requests} requests, mean refresh cpu {sum(cpu_times) / len(cpu_times):.3f}s')
+    failed = False
+    for name, (value, budget) in results.items():
+        over = value > budget
+        failed |= over
+        print(f'{name:>24}: {value:10.3f}  budget {budget:10.3f}  {"FAIL" if over else "ok"}')
+    return 1 if failed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--locations', type=int, default=20)
+    parser.add_argument('--rooms', type=int, default=5, help='rooms per location')
+    parser.add_argument('--appliances', type=int, default=3, help='appliances per room')
+    parser.add_argument('--cycles', type=int, default=20, help='refresh cycles to run')
+    parser.add_argument('--request-rate', type=float, default=1e6, help='request budget of the scheduler, per second')
+    parser.add_argument('--max-loop-lag', type=float, default=0.5, help='budget for the worst event loop lag, seconds')
+    parser.add_argument('--max-memory', type=float, default=256, help='budget for peak traced memory, MiB')
+    parser.add_argument('--max-refresh-cpu', type=float, default=5, help='budget for the CPU time of one refresh cycle, seconds')
+    sys.exit(asyncio.run(run(parser.parse_args())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Tests for the usage profile of a sense guard.
+
+Run with pytest from the Home Assistant config dir (or anywhere custom_components is importable):
+
+    python -m pytest custom_components/grohe_sense/test/test_usage_profile.py
+
+Importing the integration package pulls in Home Assistant, so it (and numpy) must be installed.
+"""
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+from ..usage_profile import compute_usage_profile
+
+TZ = ZoneInfo('Europe/Stockholm')
+NOW = datetime(2026, 10, 19, 12, 0, tzinfo=timezone.utc)
+WINDOW = timedelta(days=90)
+
+
+def daily_withdrawals(days, volume=100.0, hour=8):
+    """ One withdrawal of volume at hour local time on each of the last days, oldest first """
+    today = NOW.astimezone(TZ).date()
+    starttimes = [datetime(d.year, d.month, d.day, hour, 30, tzinfo=TZ).timestamp()
+                  for d in (today - timedelta(days=n) for n in range(days, 0, -1))]
+    return starttimes, [120.0] * days, [volume] * days
+
+
+def test_partial_history_is_not_padded_with_empty_days():
+    # A new install only has the week of history of its first fetch, far less than the 90 day window
+    profile = compute_usage_profile(*daily_withdrawals(7), TZ, NOW - WINDOW, NOW)
+
+    assert profile['days'] == 7
+    assert profile['withdrawals'] == 7
+    assert profile['typical_day'] == 100.0
+    assert profile['typical_day_profile'][8] == 100.0
+    assert profile['mean_day'] == 100.0
+    assert profile['hourly_profile'][8] == 100.0
+
+
+def test_unfinished_today_is_left_out():
+    starttimes, durations, volumes = daily_withdrawals(7)
+    today = NOW.astimezone(TZ).replace(hour=8, minute=30, second=0, microsecond=0)
+    profile = compute_usage_profile(starttimes + [today.timestamp()], durations + [120.0], volumes + [5.0],
+                                    TZ, NOW - WINDOW, NOW)
+
+    assert profile['days'] == 7
+    assert profile['withdrawals'] == 7
+    assert profile['mean_day'] == 100.0
+
+
+def test_days_without_withdrawals_within_history_count_as_zero():
+    starttimes, durations, volumes = daily_withdrawals(10)
+    # Nothing on the 6 most recent days
+    profile = compute_usage_profile(starttimes[:4], durations[:4], volumes[:4], TZ, NOW - WINDOW, NOW)
+
+    assert profile['days'] == 10
+    assert profile['typical_day'] == 0.0
+    assert profile['mean_day'] == 40.0
+
+
+def test_weekday_profile_and_percentiles():
+    profile = compute_usage_profile(*daily_withdrawals(28, volume=50.0), TZ, NOW - WINDOW, NOW)
+
+    # 4 complete weeks of 50 L a day
+    assert profile['weekday_profile'] == [50.0] * 7
+    assert profile['volume_percentiles']['p50'] == 50.0
+    assert profile['duration_percentiles']['p50'] == 120.0
+
+
+def test_no_withdrawals():
+    assert compute_usage_profile([], [], [], TZ, NOW - WINDOW, NOW) is None
+
+
+def test_only_today():
+    today = NOW.astimezone(TZ).replace(hour=8, minute=30, second=0, microsecond=0)
+    assert compute_usage_profile([today.timestamp()], [120.0], [5.0], TZ, NOW - WINDOW, NOW) is None
@@ -0,0 +1,117 @@
+"""Bounded, multi-resolution storage of measurement history."""
+import collections
+from datetime import timedelta
+
+from .const import MEASUREMENT_RAW_RETENTION, MEASUREMENT_RAW_SIZE, MEASUREMENT_TIERS
+
+
+def floor_time(t, resolution):
+    return t.replace(microsecond=0) - timedelta(seconds=int(t.timestamp()) % int(resolution.total_seconds()))
+
+
+class Bucket:
+    """ min/max/mean of the samples in [start, start + resolution) """
+    __slots__ = ('start', 'min', 'max', 'sum', 'count')
+
+    def __init__(self, start, value=None):
+        self.start = start
+        self.min = value
+        self.max = value
+        self.sum = value if value is not None else 0
+        self.count = 1 if value is not None else 0
+
+    def merge(self, other):
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        self.sum += other.sum
+        self.count += other.count
+
+    def as_dict(self):
+        return {'time': self.start, 'min': self.min, 'max': self.max, 'mean': self.sum / self.count, 'count': self.count}
+
+
+class MeasurementSeries:
+    """ One measurement of one appliance: raw samples for recent hours, then buckets of decreasing resolution.
+
+    Samples that age past the raw retention are folded into the first tier's buckets, buckets that age past
+    a tier's retention are folded into the next tier, and dropped after the last one. Every level is a
+    bounded deque, so memory stays fixed however long the series runs.
+    """
+
+    def __init__(self, raw_retention=MEASUREMENT_RAW_RETENTION, tiers=MEASUREMENT_TIERS, raw_size=MEASUREMENT_RAW_SIZE):
+        self._raw_retention = raw_retention
+        self._raw = collections.deque(maxlen=raw_size)
+        self._tiers = [(resolution, retention, collections.deque(maxlen=int(retention / resolution) + 1))
+                       for resolution, retention in tiers]
+        self.last = None
+
+    def add(self, t, value):
+        """ Appends a sample, ignoring anything not newer than the last one (responses overlap) """
+        if self.last is not None and t <= self.last:
+            return
+        if len(self._raw) == self._raw.maxlen:
+            self._fold(0, Bucket(*self._raw.popleft()))
+        self._raw.append((t, value))
+        self.last = t
+
+    def compact(self, now):
+        cutoff = now - self._raw_retention
+        while self._raw and self._raw[0][0] < cutoff:
+            self._fold(0, Bucket(*self._raw.popleft()))
+        for tier, (_, retention, buckets) in enumerate(self._tiers):
+            cutoff = now - retention
+            while buckets and buckets[0].start < cutoff:
+                self._fold(tier + 1, buckets.popleft())
+
+    def _fold(self, tier, bucket):
+        if tier >= len(self._tiers):
+            return
+        resolution, _, buckets = self._tiers[tier]
+        start = floor_time(bucket.start, resolution)
+        if buckets and start <= buckets[-1].start:
+            buckets[-1].merge(bucket)
+            return
+        if len(buckets) == buckets.maxlen:
+            self._fold(tier + 1, buckets.popleft())
+        folded = Bucket(start)
+        folded.merge(bucket)
+        buckets.append(folded)
+
+    def query(self, start=None, end=None):
+        """ Points oldest first, coarsest resolution for the oldest part, as dicts with time/min/max/mean/count """
+        points = []
+        for _, _, buckets in reversed(self._tiers):
+            points += [bucket.as_dict() for bucket in buckets]
+        points += [{'time': t, 'min': value, 'max': value, 'mean': value, 'count': 1} for t, value in self._raw]
+        return [p for p in points if (start is None or p['time'] >= start) and (end is None or p['time'] < end)]
+
+
+class TimeSeriesStore:
+    """ MeasurementSeries per appliance and measurement key """
+
+    def __init__(self):
+        self._series = {}  # applianceId -> {key: MeasurementSeries}
+
+    def last(self, applianceId):
+        """ Timestamp up to which every series of the appliance has samples, None if there are none """
+        times = [series.last for series in self._series.get(applianceId, {}).values() if series.last is not None]
+        return min(times) if times else None
+
+    def add(self, applianceId, samples, now):
+        """ Adds (timestamp, {key: value}) samples, oldest first, then compacts the appliance's series """
+        appliance_series = self._series.setdefault(applianceId, {})
+        for t, values in samples:
+            for key, value in values.items():
+                series = appliance_series.get(key)
+                if series is None:
+                    series = appliance_series[key] = MeasurementSeries()
+                series.add(t, value)
+        for series in appliance_series.values():
+            series.compact(now)
+
+    def query(self, applianceId, key, start=None, end=None):
+        series = self._series.get(applianceId, {}).get(key)
+        return series.query(start, end) if series is not None else []
+
+    def remove(self, applianceId):
+        self._series.pop(applianceId, None)
@@ -0,0 +1,85 @@
+"""Usage profiles of sense guards, computed over their stored withdrawal history."""
+from datetime import datetime, timezone
+
+import numpy as np
+
+from .const import USAGE_PROFILE_PERCENTILES
+
+SECONDS_PER_DAY = 86400
+WEEKDAY_OF_EPOCH = 3  # 1970-01-01 was a Thursday, weekdays count from Monday = 0 like datetime.weekday()
+
+
+def _local_offsets(epoch_days, tz):
+    """ UTC offset in seconds of each (UTC) day, looked up once per distinct day rather than once per withdrawal """
+    days, inverse = np.unique(epoch_days, return_inverse=True)
+    offsets = np.array([datetime.fromtimestamp(int(day) * SECONDS_PER_DAY + SECONDS_PER_DAY // 2, tz=timezone.utc)
+                        .astimezone(tz).utcoffset().total_seconds() for day in days])
+    return offsets[inverse]
+
+
+def compute_usage_profile(starttimes, durations, volumes, tz, since, now):
+    """ Profile of the withdrawals since, from parallel sequences of start times (epoch seconds), durations
+    (seconds) and volumes (litres). Hours and weekdays are in tz. None if there is no complete day of withdrawals.
+
+    The days run from the later of since and the first withdrawal up to the last complete day before now, so
+    neither a history shorter than the window (a new install) nor today's unfinished day pulls the profiles
+    down. Within that range, days without any withdrawal count as zero, so profiles are averages over all days
+    rather than over the days something happened. The typical day is the median of the daily totals, and its
+    profile the per-hour median, which (unlike the mean) aren't pulled up by the odd day of garden watering.
+    """
+    if not len(starttimes):
+        return None
+    start = np.asarray(starttimes, dtype=float)
+    duration = np.asarray(durations, dtype=float)
+    volume = np.asarray(volumes, dtype=float)
+
+    local = start + _local_offsets(np.floor_divide(start, SECONDS_PER_DAY).astype(np.int64), tz)
+    day = np.floor_divide(local, SECONDS_PER_DAY).astype(np.int64)
+    hour = (np.floor_divide(local, 3600) % 24).astype(np.int64)
+
+    first_day = int(np.floor_divide(since.astimezone(tz).replace(tzinfo=timezone.utc).timestamp(), SECONDS_PER_DAY))
+    last_day = int(np.floor_divide(now.astimezone(tz).replace(tzinfo=timezone.utc).timestamp(), SECONDS_PER_DAY)) - 1
+    first_day = max(first_day, int(day.min()))
+    if first_day > last_day:  # Nothing but today so far
+        return None
+    keep = (day >= first_day) & (day <= last_day)
+    start, duration, volume, day, hour = start[keep], duration[keep], volume[keep], day[keep], hour[keep]
+    n_days = last_day - first_day + 1
+    day_index = day - first_day
+    day_weekdays = (np.arange(first_day, last_day + 1) + WEEKDAY_OF_EPOCH) % 7
+    weekday = day_weekdays[day_index]
+
+    per_day_hour = np.bincount(day_index * 24 + hour, weights=volume, minlength=n_days * 24).reshape(n_days, 24)
+    daily = per_day_hour.sum(axis=1)
+    weekday_days = np.bincount(day_weekdays, minlength=7)
+    weekday_totals = np.bincount(weekday, weights=volume, minlength=7)
+    typical_day = np.median(per_day_hour, axis=0)
+
+    valid_duration = duration[np.isfinite(duration) & (duration >= 0)]
+
+    def rounded(values):
+        return np.round(values, 2).tolist()
+
+    def percentiles(values):
+        if not len(values):
+            return {}
+        return dict(zip((f'p{p}' for p in USAGE_PROFILE_PERCENTILES),
+                        rounded(np.percentile(values, USAGE_PROFILE_PERCENTILES))))
+
+    return {
+        'days': n_days,
+        'withdrawals': int(len(volume)),
+        'hourly_profile': rounded(per_day_hour.mean(axis=0)),
+        'weekday_profile': rounded(np.divide(weekday_totals, weekday_days, out=np.zeros(7), where=weekday_days > 0)),
+        'volume_percentiles': percentiles(volume),
+        'duration_percentiles': percentiles(valid_duration),
+        'typical_day_profile': rounded(typical_day),
+        'typical_day': round(float(np.median(daily)), 2),
+        'mean_day': round(float(daily.mean()), 2),
+    }
+
+
+def load_usage_profiles(store, applianceIds, tz, since, now):
+    """ Reads the withdrawals of each appliance from the history store and profiles them. Blocks, run it in an executor. """
+    return {applianceId: compute_usage_profile(*store.withdrawal_columns(applianceId, since), tz, since, now)
+            for applianceId in applianceIds}